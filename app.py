@@ -1,9 +1,9 @@
 import random
 import hashlib
-from flask import Flask, render_template, request, abort, redirect, url_for, jsonify, Response, send_from_directory
+from flask import Flask, render_template, request, abort, redirect, url_for, jsonify, Response, send_from_directory, g, has_request_context
 from markupsafe import Markup
 from flask_caching import Cache
-from jinja2 import Template
+from jinja2 import Template, Environment, BytecodeCache, TemplateSyntaxError
 import os
 import json
 import sqlite3
@@ -11,9 +11,18 @@ from datetime import datetime
 from markupsafe import Markup
 import re
 import urllib.parse
-
-# Cache for random seeds based on city-state pairs
-spintax_seed_cache = {}
+import click
+import threading
+import queue
+import time
+import hmac
+import math
+import bisect
+import gc
+import sys
+from array import array
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
 
 app = Flask(__name__)
 
@@ -25,17 +34,391 @@ cache = Cache(app, config={
 
 app.config['SERVER_NAME'] = 'demo.local:8000'
 
+# City database, opened read-only by the request path
+app.config['DATABASE_PATH'] = 'newcities.db'
+app.config['DATABASE_POOL_SIZE'] = 8
+# Seconds between checks for a replaced database file (0 disables hot reload)
+app.config['DATABASE_RELOAD_INTERVAL'] = int(os.environ.get('DATABASE_RELOAD_INTERVAL', 30))
+
+# Secret for signed X-Profile-Signature headers; when unset the profiler is not installed at all
+app.config['PROFILE_SECRET'] = os.environ.get('PROFILE_SECRET', '')
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+
+# Token required in the X-Admin-Token header by /admin/* endpoints (unset disables them)
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN', '')
+
+# Rendered pages are cached until one of the sources they were built from changes:
+# uploads invalidate them right away, and every hit re-checks the stamps of the
+# files a page was built from, so changes made through another worker or directly
+# on disk are picked up as well
+app.config['PAGE_CACHE_TIMEOUT'] = 0
+# Byte budgets of the rendered page cache: every domain may use its own budget
+# (PAGE_CACHE_DOMAIN_BUDGETS overrides the default per domain), pages beyond it
+# spill into an overflow pool shared by all domains
+app.config['PAGE_CACHE_DOMAIN_BUDGET'] = 32 * 1024 * 1024
+app.config['PAGE_CACHE_DOMAIN_BUDGETS'] = {}
+app.config['PAGE_CACHE_OVERFLOW_BYTES'] = 128 * 1024 * 1024
+
+# Admission control in front of cold page renders (cached pages always bypass it).
+# Token buckets refill at RATE requests per second up to BURST; the client bucket is
+# keyed by X-Real-IP (set by nginx), the domain bucket only applies to crawlers.
+app.config['ADMISSION_ENABLED'] = os.environ.get('ADMISSION_ENABLED', '1').lower() not in ('0', 'false', 'no')
+app.config['ADMISSION_CLIENT_RATE'] = 10.0
+app.config['ADMISSION_CLIENT_BURST'] = 40
+app.config['ADMISSION_DOMAIN_RATE'] = 50.0
+app.config['ADMISSION_DOMAIN_BURST'] = 200
+app.config['ADMISSION_MAX_COLD_RENDERS'] = 8
+# Crawlers may only use this many of the cold render slots and never wait for one
+app.config['ADMISSION_BOT_MAX_COLD_RENDERS'] = 4
+# Seconds a regular visitor waits for a cold render slot before getting a 503
+app.config['ADMISSION_QUEUE_TIMEOUT'] = 5.0
+app.config['ADMISSION_MAX_TRACKED_KEYS'] = 50000
+
+# Concurrent cold renders of the same page are coalesced: one request renders, the
+# others wait up to COALESCE_TIMEOUT seconds for its response, then render themselves
+app.config['COALESCE_RENDERS'] = True
+app.config['COALESCE_TIMEOUT'] = 10.0
+
+# Upper bounds for the in-process spintax caches (entries, LRU eviction)
+app.config['SPINTAX_TEMPLATE_CACHE_SIZE'] = 256
+app.config['SPINTAX_CHOICE_CACHE_SIZE'] = 20000
+
+
+class BoundedCache:
+    """Thread-safe LRU mapping that never holds more than max_entries items"""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+                return self._data[key]
+            except KeyError:
+                return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def items(self):
+        """Snapshot of the (key, value) pairs, least recently used first"""
+        with self._lock:
+            return list(self._data.items())
+
+
+class PartitionedCache:
+    """Byte-budgeted LRU cache partitioned by domain, with a shared overflow pool.
+
+    A domain's entries live in its own partition up to its budget. When the
+    partition is full its least recently used entries move to the overflow pool,
+    which is shared by every domain and evicts its own least recently used
+    entries. A domain can therefore never evict another domain's partition.
+    An entry larger than its domain's whole budget goes straight to the overflow
+    pool instead of pushing the partition out.
+
+    on_evict(key) is called, outside the lock, for every entry the cache drops by
+    itself (evicted, expired or cleared), not for delete() and delete_many().
+    """
+    def __init__(self, default_budget, overflow_bytes, budgets=None, timeout=0, on_evict=None):
+        self.default_budget = default_budget
+        self.overflow_bytes = overflow_bytes
+        self.budgets = budgets if budgets is not None else {}
+        self.timeout = timeout
+        self.on_evict = on_evict
+        self._partitions = {}        # domain -> OrderedDict(key -> (value, size, expires))
+        self._partition_bytes = {}   # domain -> bytes held in its partition
+        self._overflow = OrderedDict()  # key -> (domain, value, size, expires)
+        self._overflow_used = 0
+        self._domains = {}           # key -> domain
+        self._stats = {}             # domain -> counters
+        self._lock = threading.Lock()
+
+    def _counters(self, domain):
+        counters = self._stats.get(domain)
+        if counters is None:
+            counters = self._stats[domain] = {'hits': 0, 'misses': 0, 'sets': 0, 'evictions': 0, 'rejected': 0}
+        return counters
+
+    def budget(self, domain):
+        return self.budgets.get(domain, self.default_budget)
+
+    def get(self, domain, key, default=None, count=True):
+        """Return the cached value; count=False leaves the hit/miss counters alone"""
+        expired = False
+        with self._lock:
+            counters = self._counters(domain) if count else Counter()
+            partition = self._partitions.get(domain)
+            entry = partition.get(key) if partition is not None else None
+            if entry is not None:
+                value, _, expires = entry
+                if not expires or expires > time.monotonic():
+                    partition.move_to_end(key)
+                    counters['hits'] += 1
+                    return value
+                expired = self._remove(key)
+            else:
+                entry = self._overflow.get(key)
+                if entry is not None and entry[0] == domain:
+                    _, value, _, expires = entry
+                    if not expires or expires > time.monotonic():
+                        self._overflow.move_to_end(key)
+                        counters['hits'] += 1
+                        return value
+                    expired = self._remove(key)
+            counters['misses'] += 1
+        if expired:
+            self._evicted([key])
+        return default
+
+    def set(self, domain, key, value, size):
+        """Store value (size bytes) for domain; return False if it cannot fit at all"""
+        with self._lock:
+            counters = self._counters(domain)
+            self._remove(key)
+            budget = self.budget(domain)
+            if size > max(budget, self.overflow_bytes):
+                counters['rejected'] += 1
+                return False
+            expires = time.monotonic() + self.timeout if self.timeout else 0
+            self._domains[key] = domain
+            counters['sets'] += 1
+            if size > budget:
+                # Would push the whole partition out, keep it in the shared pool only
+                self._overflow[key] = (domain, value, size, expires)
+                self._overflow_used += size
+            else:
+                partition = self._partitions.setdefault(domain, OrderedDict())
+                partition[key] = (value, size, expires)
+                self._partition_bytes[domain] = self._partition_bytes.get(domain, 0) + size
+                # Spill this domain's least recently used entries into the shared pool
+                while self._partition_bytes[domain] > budget:
+                    old_key, (old_value, old_size, old_expires) = partition.popitem(last=False)
+                    self._partition_bytes[domain] -= old_size
+                    self._overflow[old_key] = (domain, old_value, old_size, old_expires)
+                    self._overflow_used += old_size
+            evicted = []
+            while self._overflow_used > self.overflow_bytes:
+                old_key, (old_domain, _, old_size, _) = self._overflow.popitem(last=False)
+                self._overflow_used -= old_size
+                del self._domains[old_key]
+                self._counters(old_domain)['evictions'] += 1
+                evicted.append(old_key)
+        self._evicted(evicted)
+        return True
+
+    def _evicted(self, keys):
+        if self.on_evict is not None:
+            for key in keys:
+                self.on_evict(key)
+
+    def _remove(self, key):
+        """Drop key if present, return True if it was"""
+        domain = self._domains.pop(key, None)
+        if domain is None:
+            return False
+        partition = self._partitions.get(domain)
+        if partition is not None and key in partition:
+            self._partition_bytes[domain] -= partition.pop(key)[1]
+        elif key in self._overflow:
+            self._overflow_used -= self._overflow.pop(key)[2]
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def delete_many(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._domains)
+            self._partitions.clear()
+            self._partition_bytes.clear()
+            self._overflow.clear()
+            self._overflow_used = 0
+            self._domains.clear()
+        self._evicted(keys)
+
+    def items(self):
+        """Snapshot of the (key, value) pairs of every partition and the overflow pool"""
+        with self._lock:
+            pairs = [(key, entry[0]) for partition in self._partitions.values() for key, entry in partition.items()]
+            pairs.extend((key, entry[1]) for key, entry in self._overflow.items())
+            return pairs
+
+    def __len__(self):
+        return len(self._domains)
+
+    def stats(self):
+        """Per-domain occupancy (partition and overflow bytes) and hit rates"""
+        with self._lock:
+            overflow_by_domain = {}
+            for domain, _, size, _ in self._overflow.values():
+                overflow_by_domain[domain] = overflow_by_domain.get(domain, 0) + size
+            domains = {}
+            for domain in sorted(set(self._stats) | set(self._partitions)):
+                counters = self._counters(domain)
+                lookups = counters['hits'] + counters['misses']
+                domains[domain] = dict(
+                    counters,
+                    entries=len(self._partitions.get(domain, ())) +
+                        sum(1 for entry in self._overflow.values() if entry[0] == domain),
+                    budget_bytes=self.budget(domain),
+                    partition_bytes=self._partition_bytes.get(domain, 0),
+                    overflow_bytes=overflow_by_domain.get(domain, 0),
+                    hit_rate=round(counters['hits'] / lookups, 4) if lookups else None,
+                )
+            return {
+                'overflow_budget_bytes': self.overflow_bytes,
+                'overflow_used_bytes': self._overflow_used,
+                'domains': domains,
+            }
+
+
+class ConnectionPool:
+    """Thread-safe pool of read-only SQLite connections.
+
+    Connections are opened with mode=ro but not immutable=1: the file may be
+    updated in place or replaced while connections are open (see reload_database),
+    and SQLite only keeps reads consistent across such changes while it is allowed
+    to lock the file and detect them. Each connection keeps its own prepared statement
+    cache (cached_statements), so the constant SQL strings below are parsed once per
+    connection. Call reset() after the database file has been replaced.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.generation = 0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._schema_version = None
+
+    def _connect(self):
+        uri = f"file:{urllib.parse.quote(os.path.abspath(self.path))}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=64)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            generation, conn = self._idle.get_nowait()
+        except queue.Empty:
+            generation, conn = self.generation, self._connect()
+        try:
+            yield conn
+        finally:
+            if generation == self.generation and self._idle.qsize() < self.size:
+                self._idle.put((generation, conn))
+            else:
+                conn.close()
+
+    @property
+    def schema_version(self):
+        """PRAGMA user_version of the database (see DB_MIGRATIONS)"""
+        if self._schema_version is None:
+            with self.connection() as conn:
+                self._schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        return self._schema_version
+
+    def reset(self):
+        """Close idle connections; connections in use are closed when they are returned"""
+        with self._lock:
+            self.generation += 1
+            self._schema_version = None
+            while True:
+                try:
+                    _, conn = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                conn.close()
+
+db_pool = ConnectionPool(app.config['DATABASE_PATH'], app.config['DATABASE_POOL_SIZE'])
+
+def city_slug(city_name):
+    """Normalized city name as it appears in subdomains (lowercase, hyphens instead of spaces)"""
+    return city_name.lower().replace(' ', '-')
+
+# Schema migrations, applied in order by `flask --app app migrate-db`.
+# PRAGMA user_version records how many have been applied.
+DB_MIGRATIONS = [
+    # 1) normalized slug columns with an index for subdomain lookups, kept up to date by triggers
+    """
+    ALTER TABLE Cities ADD COLUMN city_slug TEXT;
+    ALTER TABLE Cities ADD COLUMN state_slug TEXT;
+    UPDATE Cities SET city_slug = lower(replace(city_name, ' ', '-')), state_slug = lower(state_code);
+    CREATE INDEX IF NOT EXISTS idx_cities_state_slug_city_slug ON Cities(state_slug, city_slug);
+    CREATE TRIGGER IF NOT EXISTS cities_slug_insert AFTER INSERT ON Cities BEGIN
+        UPDATE Cities SET city_slug = lower(replace(NEW.city_name, ' ', '-')), state_slug = lower(NEW.state_code)
+         WHERE id = NEW.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS cities_slug_update AFTER UPDATE OF city_name, state_code ON Cities BEGIN
+        UPDATE Cities SET city_slug = lower(replace(NEW.city_name, ' ', '-')), state_slug = lower(NEW.state_code)
+         WHERE id = NEW.id;
+    END;
+    """,
+]
+
+def migrate_database(path):
+    """Apply pending DB_MIGRATIONS to the database file, return the new schema version"""
+    with sqlite3.connect(path) as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(DB_MIGRATIONS[version:], start=version + 1):
+            print(f"Applying database migration {number}")
+            conn.executescript(f"BEGIN; {migration} PRAGMA user_version = {number}; COMMIT;")
+            if number == 1:
+                # SQLite's lower() only folds ASCII, recompute slugs with Python for the existing rows
+                rows = conn.execute("SELECT id, city_name FROM Cities").fetchall()
+                conn.executemany("UPDATE Cities SET city_slug = ? WHERE id = ?",
+                                 [(city_slug(name), row_id) for row_id, name in rows])
+                conn.commit()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+    db_pool.reset()
+    return version
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Apply pending schema migrations to the city database."""
+    version = migrate_database(app.config['DATABASE_PATH'])
+    print(f"Database schema is at version {version}")
+
+def database_version(path):
+    """Version of the database file, changes whenever the file is replaced or rewritten"""
+    st = os.stat(path)
+    return f"{st.st_mtime_ns}-{st.st_size}"
 
 # Database cache initialization
 class DatabaseCache:
-    def __init__(self):
+    def __init__(self, pool=None):
+        self.pool = pool or db_pool
+        self.version = database_version(self.pool.path)
         self.states = {}
         self.cities = {}
         self.zip_codes = {}
+        # (state, city slug) -> (city name, main zip code), used to diff reloads
+        self.city_index = {}
         self._load_data()
     def _load_data(self):
-        with sqlite3.connect('newcities.db') as conn:
-            conn.row_factory = sqlite3.Row
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             # 1) load every distinct state
@@ -51,50 +434,910 @@ class DatabaseCache:
                 city = row['city_name']
                 # add city→state index
                 self.cities.setdefault(abbr, []).append(city)
+                self.city_index.setdefault((abbr, city_slug(city)), (city, row['main_zip_code']))
                 # add zip index
                 key = city.lower()
                 zips = [z.strip() for z in row['zip_codes'].split(',') if z.strip()]
                 self.zip_codes.setdefault(key, []).extend(zips)
-                
+
+        # 3) precompute spintax seeds for every valid city page and state page, so
+        # rendering never hashes or allocates for known keys and bogus keys are never stored
+        self.spintax_seeds = {}
+        for abbr, cities in self.cities.items():
+            state_abbreviation = abbr.upper()
+            self.spintax_seeds[f"|{state_abbreviation}"] = spintax_seed(f"|{state_abbreviation}")
+            for city in cities:
+                city_state_key = f"{city.title()}|{state_abbreviation}"
+                self.spintax_seeds[city_state_key] = spintax_seed(city_state_key)
+
+        # 4) sorted prefix index for city autocomplete (/api/cities)
+        self.city_search = CitySearchIndex(self.cities)
+
+
+class CitySearchIndex:
+    """Case-insensitive city name prefix search over sorted arrays.
+
+    Every state has its own sorted array of lowercased names, plus one array for
+    all states; a lookup is a bisect to the first match followed by a scan of at
+    most limit entries, so it never touches the database.
+    """
+    def __init__(self, cities):
+        entries = sorted({(city.lower(), (abbr, city)) for abbr, names in cities.items() for city in names})
+        self._all = ([name for name, _ in entries], [pair for _, pair in entries])
+        self._states = {}
+        for name, pair in entries:
+            keys, values = self._states.setdefault(pair[0], ([], []))
+            keys.append(name)
+            values.append(pair)
+
+    def items(self):
+        """(state, arrays) pairs, with None for the all-states arrays"""
+        return [(None, self._all)] + list(self._states.items())
+
+    def search(self, prefix, state=None, limit=10):
+        """Return up to limit (state, city) pairs whose name starts with prefix, in name order"""
+        keys, values = self._all if state is None else self._states.get(state, ((), ()))
+        prefix = prefix.lower()
+        start = bisect.bisect_left(keys, prefix)
+        end = min(len(keys), start + limit)
+        matches = []
+        for i in range(start, end):
+            if not keys[i].startswith(prefix):
+                break
+            matches.append(values[i])
+        return matches
+
+def spintax_seed(city_state_key):
+    """Create a reproducible 32-bit seed by hashing the city-state key"""
+    hash_obj = hashlib.md5(city_state_key.encode())
+    return int(hash_obj.hexdigest(), 16) % (2**32)
+
 # Initialize database cache at startup
 db_cache = DatabaseCache()
 
-@cache.memoize(timeout=300)
+# Statistics of the most recent database reload, see reload_database()
+last_db_reload = {}
+db_reload_lock = threading.Lock()
+
+def current_rss_kb():
+    """Resident set size of this process in KiB (0 where /proc is unavailable)"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def deep_sizeof(obj):
+    """Approximate memory held by obj and everything reachable through containers"""
+    seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif hasattr(item, '__dict__') and not isinstance(item, type):
+            stack.append(vars(item))
+    return total
+
+def diff_database_caches(old, new):
+    """Return the dependency sources (see DependencyGraph) whose data differs between two caches"""
+    sources = set()
+    if old.states != new.states:
+        sources.add("db:states")
+    for abbr in set(old.states) | set(new.states):
+        if old.states.get(abbr) != new.states.get(abbr) or \
+                sorted(old.cities.get(abbr, [])) != sorted(new.cities.get(abbr, [])):
+            sources.add(f"state:{abbr}")
+    for key in set(old.city_index) | set(new.city_index):
+        if old.city_index.get(key) != new.city_index.get(key):
+            sources.add(f"city:{key[0]}:{key[1]}")
+    for name in set(old.zip_codes) | set(new.zip_codes):
+        if old.zip_codes.get(name) != new.zip_codes.get(name):
+            sources.add(f"zips:{name}")
+    return sources
+
+def reload_database(force=False):
+    """Rebuild the city index from the database file and swap it in atomically.
+
+    The new DatabaseCache is built on a fresh connection pool while requests keep
+    being served from the current one. Only rendered pages whose city, state or zip
+    data changed are invalidated. Returns the reload statistics, or None when the
+    file has not changed since the last load.
+    """
+    global db_cache, db_pool
+    with db_reload_lock:
+        path = db_pool.path
+        if not force and database_version(path) == db_cache.version:
+            return None
+
+        started = time.perf_counter()
+        rss_before = current_rss_kb()
+        new_pool = ConnectionPool(path, db_pool.size)
+        new_cache = DatabaseCache(new_pool)
+        rss_during_swap = current_rss_kb()
+        build_ms = (time.perf_counter() - started) * 1000
+
+        old_cache, old_pool = db_cache, db_pool
+        changed_sources = diff_database_caches(old_cache, new_cache)
+        # Rebinding module globals is atomic, requests see either the old or the new pair
+        db_pool, db_cache = new_pool, new_cache
+        old_pool.reset()
+
+        changed_states = {source.split(':', 1)[1] for source in changed_sources if source.startswith('state:')}
+        for abbr in changed_states:
+            cache.delete_memoized(get_cities_in_state, abbr)
+            cache.delete_memoized(state_exists, abbr)
+            cache.delete_memoized(get_state_full_name, abbr)
+        invalidated_pages = invalidate_dependents(changed_sources)
+
+        previous_version = old_cache.version
+        del old_cache
+        gc.collect()
+        stats = {
+            'version': new_cache.version,
+            'previous_version': previous_version,
+            'reload_ms': round((time.perf_counter() - started) * 1000, 2),
+            'build_ms': round(build_ms, 2),
+            'index_bytes': deep_sizeof((new_cache.states, new_cache.cities, new_cache.zip_codes,
+                                        new_cache.city_index, new_cache.spintax_seeds)),
+            'rss_before_kb': rss_before,
+            'rss_during_swap_kb': rss_during_swap,
+            'rss_after_kb': current_rss_kb(),
+            'swap_overhead_kb': max(0, rss_during_swap - rss_before),
+            'changed_sources': len(changed_sources),
+            'invalidated_pages': invalidated_pages,
+        }
+        last_db_reload.clear()
+        last_db_reload.update(stats)
+        print(f"Reloaded {path} in {stats['reload_ms']}ms (build {stats['build_ms']}ms, "
+              f"swap overhead {stats['swap_overhead_kb']}KiB), invalidated {invalidated_pages} pages")
+        return stats
+
+class DatabaseWatcher(threading.Thread):
+    """Background thread that reloads the city database when its file changes"""
+    def __init__(self, interval):
+        super().__init__(name='database-watcher', daemon=True)
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                reload_database()
+            except Exception as e:
+                print(f"Error reloading database: {e}")
+
+database_watcher = None
+
+def start_database_watcher():
+    """Start the watcher once per worker process (threads do not survive a fork)"""
+    global database_watcher
+    if database_watcher is None and app.config['DATABASE_RELOAD_INTERVAL'] > 0:
+        with db_reload_lock:
+            if database_watcher is None:
+                database_watcher = DatabaseWatcher(app.config['DATABASE_RELOAD_INTERVAL'])
+                database_watcher.start()
+
+def require_admin_token():
+    """Abort unless the request carries the configured admin token"""
+    token = app.config['ADMIN_TOKEN']
+    if not token:
+        abort(403)
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token):
+        abort(403)
+
+def file_stamp(path):
+    """(mtime, size, inode) of a file, None if it does not exist; changes whenever the file is rewritten"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def record_file_stamp(path, stamp):
+    """Remember the version of a file the page being rendered was built from"""
+    if has_request_context():
+        stamps = g.get('page_file_stamps')
+        if stamps is not None:
+            stamps[path] = stamp
+
 def load_json(filename):
+    """Parsed JSON file; the memo is keyed by the file's stamp, so edits made by
+    another worker or directly on disk are picked up on the next call"""
+    stamp = file_stamp(filename)
+    record_file_stamp(filename, stamp)
+    return _load_json(filename, stamp)
+
+@cache.memoize(timeout=300)
+def _load_json(filename, stamp):
     with open(filename, 'r') as f:
         return json.load(f)
 
-@cache.memoize(timeout=3600)
+# Optional minification of page sources, applied once when a source is loaded or uploaded
+app.config['MINIFY_HTML'] = os.environ.get('MINIFY_HTML', '').lower() in ('1', 'true', 'yes')
+
+# Blocks kept byte for byte by the minifier: conditional comments, comments,
+# script/style (including JSON-LD), pre and textarea elements, and Jinja
+# {{ }} / {% %} constructs, whose string literals may hold significant whitespace
+MINIFY_PRESERVE_PATTERN = re.compile(
+    r'<!--\[if.*?<!\[endif\]-->|<!--.*?-->|<(script|style|pre|textarea)\b[^>]*>.*?</\1\s*>|\{\{.*?\}\}|\{%.*?%\}',
+    re.DOTALL | re.IGNORECASE
+)
+HTML_WHITESPACE_PATTERN = re.compile(r'[ \t\r\n\f]+')
+# Comments the minifier may drop, everything but conditional comments
+REMOVABLE_COMMENT_PATTERN = re.compile(r'<!--(?!\[if).*?-->', re.DOTALL)
+# A comment holding any of these can take part in spintax or Jinja and is kept
+SPINTAX_CHARS = '{}|'
+
+def _collapse_whitespace(match):
+    return '\n' if '\n' in match.group(0) else ' '
+
+def minify_html(text, collapse=True):
+    """Drop authoring comments and collapse whitespace runs outside preserved blocks.
+
+    Comments containing '{', '}' or '|' are kept: they may hold Jinja tags or be
+    part of a spintax group ('{a|b<!-- } -->c}'), and spintax inside them still
+    consumes a choice, so removing them would change the rendered page. Every
+    whitespace run becomes a single space (or newline), so spintax options and
+    [Placeholder] tokens keep their meaning.
+    """
+    out = []
+    gap = []
+
+    def flush():
+        if gap:
+            joined = ''.join(gap)
+            out.append(HTML_WHITESPACE_PATTERN.sub(_collapse_whitespace, joined) if collapse else joined)
+            gap.clear()
+
+    position = 0
+    for match in MINIFY_PRESERVE_PATTERN.finditer(text):
+        gap.append(text[position:match.start()])
+        block = match.group(0)
+        if block.startswith('<!--') and not block.startswith('<!--[if') and \
+                not any(char in block for char in SPINTAX_CHARS):
+            pass  # removable comment, the surrounding whitespace merges into one run
+        else:
+            flush()
+            out.append(block)
+        position = match.end()
+    gap.append(text[position:])
+    flush()
+    return ''.join(out)
+
+def _comparable_render(text):
+    """A sample render of text without comments and with every whitespace run as one space"""
+    text = REMOVABLE_COMMENT_PATTERN.sub('', sample_page_render(text))
+    return HTML_WHITESPACE_PATTERN.sub(' ', text)
+
+def minified_equivalent(original, minified):
+    """True if the pages rendered from original and minified differ only in whitespace and comments"""
+    return _comparable_render(original) == _comparable_render(minified)
+
+def prepare_page_source(text):
+    """Transform applied to every page source before it is stored (see MINIFY_HTML)"""
+    if not app.config['MINIFY_HTML']:
+        return text
+    minified = minify_html(text)
+    if not minified_equivalent(text, minified):
+        print("Warning: minified page differs beyond whitespace, serving it unminified")
+        return text
+    return minified
+
+class ContentStore:
+    """Content-addressed storage for page sources and their compiled artifacts.
+
+    Every file path maps to the SHA-1 digest of its content; identical content
+    loaded for any number of domains is held once, and artifacts compiled from it
+    (Jinja templates, fragment tokens) are built once per digest. A blob and its
+    artifacts are dropped when no path refers to it any more.
+    """
+    def __init__(self, timeout, transform=None):
+        self.timeout = timeout
+        self.transform = transform
+        self._blobs = {}      # digest -> text
+        self._refs = {}       # digest -> number of paths referring to it
+        self._paths = {}      # path -> (digest, loaded at, file stamp)
+        self._artifacts = {}  # digest -> {kind: artifact}
+        self._lock = threading.Lock()
+
+    def load(self, path):
+        """Return the content of path, reading the file when it is not loaded, expired or changed on disk"""
+        return self.load_stamped(path)[0]
+
+    def load_stamped(self, path):
+        """Return (content, file stamp) of path; content is None if the file does not exist"""
+        stamp = file_stamp(path)
+        if stamp is None:
+            self.forget(path)
+            return None, None
+        with self._lock:
+            entry = self._paths.get(path)
+            if entry is not None and entry[2] == stamp and \
+                    (not self.timeout or time.monotonic() - entry[1] < self.timeout):
+                return self._blobs[entry[0]], stamp
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        prepared = load_compiled_source(path, text)
+        if prepared is not None:
+            return self.put(path, prepared, transformed=True, stamp=stamp), stamp
+        return self.put(path, text, stamp=stamp), stamp
+
+    def put(self, path, text, transformed=False, stamp=None):
+        """Store text (after the store's transform) as the content of path and return the shared copy.
+
+        stamp is the file_stamp() of the file text was read from; without one the
+        next load() reads the file again.
+        """
+        if self.transform is not None and not transformed:
+            text = self.transform(text)
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        with self._lock:
+            old = self._paths.get(path)
+            self._paths[path] = (digest, time.monotonic(), stamp)
+            if old is not None and old[0] == digest:
+                return self._blobs[digest]
+            blob = self._blobs.setdefault(digest, text)
+            self._refs[digest] = self._refs.get(digest, 0) + 1
+            if old is not None:
+                self._release(old[0])
+            return blob
+
+    def digest_for(self, path):
+        with self._lock:
+            entry = self._paths.get(path)
+            return entry[0] if entry is not None else None
+
+    def forget(self, path):
+        with self._lock:
+            entry = self._paths.pop(path, None)
+            if entry is not None:
+                self._release(entry[0])
+
+    def forget_all(self):
+        with self._lock:
+            self._paths.clear()
+            self._blobs.clear()
+            self._refs.clear()
+            self._artifacts.clear()
+
+    def _release(self, digest):
+        self._refs[digest] -= 1
+        if not self._refs[digest]:
+            del self._refs[digest]
+            del self._blobs[digest]
+            self._artifacts.pop(digest, None)
+
+    def artifact(self, digest, kind, build):
+        """Return the artifact of kind compiled from digest, building it on first use"""
+        with self._lock:
+            artifact = self._artifacts.get(digest, {}).get(kind)
+        if artifact is None:
+            artifact = build()
+            with self._lock:
+                if digest in self._blobs:
+                    self._artifacts.setdefault(digest, {})[kind] = artifact
+        return artifact
+
+    def items(self):
+        """Snapshot of (path, text, artifacts) for every stored path"""
+        with self._lock:
+            return [(path, self._blobs[digest], self._artifacts.get(digest, {}))
+                    for path, (digest, _, _) in self._paths.items()]
+
+    def stats(self):
+        """Dedup statistics: logical (per path) versus stored (per digest) memory"""
+        with self._lock:
+            logical = sum(sys.getsizeof(self._blobs[digest]) for digest, _, _ in self._paths.values())
+            stored = sum(sys.getsizeof(text) for text in self._blobs.values())
+            return {
+                'paths': len(self._paths),
+                'unique_sources': len(self._blobs),
+                'artifacts': sum(len(kinds) for kinds in self._artifacts.values()),
+                'logical_bytes': logical,
+                'stored_bytes': stored,
+                'saved_bytes': logical - stored,
+                'dedup_ratio': round(logical / stored, 2) if stored else 1.0,
+            }
+
+app.config['HTML_CACHE_TIMEOUT'] = 3600
+html_store = ContentStore(app.config['HTML_CACHE_TIMEOUT'], transform=prepare_page_source)
+
 def load_html_file(file_path):
     """Load HTML file from disk and cache it"""
     try:
-        if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        return None
+        content, stamp = html_store.load_stamped(file_path)
+        record_file_stamp(file_path, stamp)
+        return content
     except Exception as e:
         print(f"Error loading HTML file {file_path}: {e}")
         return None
 
+def get_page_template(file_path, content):
+    """Compiled Jinja template of a page source, shared by every domain with the same content"""
+    digest = html_store.digest_for(file_path)
+    if digest is None:
+        return Template(content)
+    return html_store.artifact(digest, 'jinja', lambda: compile_page_template(file_path, digest, content))
+
+# Artifacts compiled at upload time live next to the page sources, in
+# domains/<domain>/.compiled/, so workers read them instead of compiling:
+#     <page>.json         source checksum, digest of the prepared source, MINIFY_HTML setting
+#     <digest>.source     the prepared (possibly minified) source
+#     <digest>.tokens     fragment tokens (tokenize_page_source) as JSON
+#     <digest>.jinja      Jinja bytecode of the TEMPLATE_PAGES
+COMPILED_DIR = '.compiled'
+# Pages rendered straight from their source as Jinja templates (get_page_template).
+# City and service pages are rendered as templates only after their placeholders
+# were replaced, so their template source differs for every city and is compiled
+# per render; no bytecode artifact is written for them.
+TEMPLATE_PAGES = ('home.html', 'state.html')
+
+def compiled_path(page_path, name):
+    return os.path.join(os.path.dirname(page_path), COMPILED_DIR, name)
+
+def _write_atomic(path, data):
+    """Write bytes so concurrent readers see either the old or the new file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+def _read_compiled(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def load_compiled_source(page_path, text):
+    """The prepared source compiled at upload for exactly this text, or None"""
+    manifest = _read_compiled(compiled_path(page_path, os.path.basename(page_path) + '.json'))
+    if manifest is None:
+        return None
+    try:
+        manifest = json.loads(manifest)
+    except ValueError:
+        return None
+    if manifest.get('source') != hashlib.sha1(text.encode('utf-8')).hexdigest() or \
+            manifest.get('minify') != app.config['MINIFY_HTML']:
+        return None
+    prepared = _read_compiled(compiled_path(page_path, f"{manifest['digest']}.source"))
+    if prepared is None or hashlib.sha1(prepared).hexdigest() != manifest['digest']:
+        return None
+    return prepared.decode('utf-8')
+
+def _as_tuples(value):
+    """JSON arrays back to the tuples tokenize_page_source builds"""
+    if isinstance(value, list):
+        return tuple(_as_tuples(item) for item in value)
+    return value
+
+def dump_page_tokens(tokens):
+    """Serialize tokenize_page_source() output; only plain JSON, never code"""
+    if tokens == NOT_FRAGMENTABLE:
+        return b'null'
+    parts, spintax = tokens
+    return json.dumps({
+        'parts': parts,
+        'spintax': {
+            'digest': spintax.digest.hex(),
+            'literals': spintax.literals,
+            'groups': [[group.index, group.options] for group in spintax.groups],
+            'option_counts': spintax.option_counts,
+        },
+    }).encode('utf-8')
+
+def load_page_tokens(data):
+    """Inverse of dump_page_tokens"""
+    tokens = json.loads(data)
+    if tokens is None:
+        return NOT_FRAGMENTABLE
+    spintax = tokens['spintax']
+    return _as_tuples(tokens['parts']), SpintaxTemplate(
+        bytes.fromhex(spintax['digest']),
+        _as_tuples(spintax['literals']),
+        tuple(SpintaxGroup(index, _as_tuples(options)) for index, options in spintax['groups']),
+        _as_tuples(spintax['option_counts']),
+    )
+
+def load_compiled_tokens(page_path, digest, source):
+    """Fragment tokens of a prepared source, read from the upload artifact when present"""
+    data = _read_compiled(compiled_path(page_path, f"{digest}.tokens"))
+    if data is not None:
+        try:
+            return load_page_tokens(data)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"DEBUG: Ignoring unreadable tokens artifact for {page_path}: {e}")
+    return tokenize_page_source(source)
+
+class PageBytecodeCache(BytecodeCache):
+    """Jinja bytecode stored as <digest>.jinja next to the page source (see COMPILED_DIR)"""
+    def __init__(self, page_path):
+        self.page_path = page_path
+
+    def get_cache_key(self, name, filename=None):
+        return name
+
+    def load_bytecode(self, bucket):
+        data = _read_compiled(compiled_path(self.page_path, f"{bucket.key}.jinja"))
+        if data is not None:
+            bucket.bytecode_from_string(data)
+
+    def dump_bytecode(self, bucket):
+        _write_atomic(compiled_path(self.page_path, f"{bucket.key}.jinja"), bucket.bytecode_to_string())
+
+# Same defaults as jinja2.Template(source)
+page_template_env = Environment()
+
+def compile_page_template(page_path, digest, content, store=False):
+    """Build the Jinja template of a prepared source, from its bytecode artifact if present.
+
+    With store=True (at upload), freshly compiled bytecode is written next to the source.
+    """
+    bytecode_cache = PageBytecodeCache(page_path)
+    bucket = bytecode_cache.get_bucket(page_template_env, digest, None, content)
+    code = bucket.code
+    if code is None:
+        code = page_template_env.compile(content)
+        if store:
+            bucket.code = code
+            bytecode_cache.set_bucket(bucket)
+    return page_template_env.template_class.from_code(page_template_env, code, page_template_env.make_globals(None))
+
+def page_uses_jinja(page_path, text):
+    """True if the page is rendered as a Jinja template (see handle_home and handle_page)"""
+    return os.path.basename(page_path) in TEMPLATE_PAGES or "{% for" in text or "{{ " in text
+
+# City whose spintax choices are used to check the Jinja syntax of city and service pages
+SAMPLE_CITY_STATE_KEY = 'Springfield|IL'
+
+def sample_page_render(text):
+    """A city or service page source as handle_home and handle_page pass it to Jinja:
+    spintax resolved for SAMPLE_CITY_STATE_KEY and every placeholder replaced"""
+    text, fully_protected_blocks, schema_blocks = protect_blocks(text)
+    text = resolve_spintax(text, SAMPLE_CITY_STATE_KEY)
+    replacements = {name: 'Sample' for name in PLACEHOLDER_NAMES}
+    for placeholder, value in replacements.items():
+        text = text.replace(placeholder, value)
+    return restore_blocks(text, fully_protected_blocks, schema_blocks, replacements)
+
+def validate_page_source(page_path, text):
+    """Return an error message if the page would fail to render, else None"""
+    text = prepare_page_source(text)
+    if os.path.basename(page_path) not in TEMPLATE_PAGES:
+        # Only the resolved text is a template, '{%20 off|sale}' is a spintax group
+        text = sample_page_render(text)
+    if not page_uses_jinja(page_path, text):
+        return None
+    try:
+        page_template_env.parse(text)
+    except TemplateSyntaxError as e:
+        return f"Template error in {os.path.basename(page_path)} line {e.lineno}: {e.message}"
+    return None
+
+def compile_page_artifacts(page_path, text, prepared):
+    """Write the upload-time artifacts of a page and drop the ones of its previous version"""
+    digest = hashlib.sha1(prepared.encode('utf-8')).hexdigest()
+    manifest_path = compiled_path(page_path, os.path.basename(page_path) + '.json')
+    previous = _read_compiled(manifest_path)
+
+    _write_atomic(compiled_path(page_path, f"{digest}.source"), prepared.encode('utf-8'))
+    _write_atomic(compiled_path(page_path, f"{digest}.tokens"), dump_page_tokens(tokenize_page_source(prepared)))
+    if os.path.basename(page_path) in TEMPLATE_PAGES:
+        compile_page_template(page_path, digest, prepared, store=True)
+    _write_atomic(manifest_path, json.dumps({
+        'source': hashlib.sha1(text.encode('utf-8')).hexdigest(),
+        'digest': digest,
+        'minify': app.config['MINIFY_HTML'],
+    }).encode('utf-8'))
+
+    if previous is not None:
+        try:
+            old_digest = json.loads(previous)['digest']
+        except (ValueError, KeyError):
+            old_digest = None
+        if old_digest and old_digest != digest and not _digest_in_use(page_path, old_digest):
+            for kind in ('source', 'tokens', 'jinja'):
+                try:
+                    os.remove(compiled_path(page_path, f"{old_digest}.{kind}"))
+                except OSError:
+                    pass
+    return digest
+
+def _digest_in_use(page_path, digest):
+    """True if another page manifest in the same directory refers to digest"""
+    directory = compiled_path(page_path, '')
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            data = _read_compiled(os.path.join(directory, name))
+            if data and f'"{digest}"' in data.decode('utf-8', 'replace'):
+                return True
+    return False
+
 # Function to invalidate HTML cache when JSON files are updated
 def invalidate_html_cache():
     """Invalidate the HTML file cache"""
     print("DEBUG: Invalidating HTML cache")
-    cache.delete_memoized(load_html_file)
+    html_store.forget_all()
     # Also invalidate the cities cache
     cache.delete_memoized(get_cities_in_state)
+    # Rendered pages were built from those files, drop them as well
+    invalidate_pages(dependency_graph.pages())
+
+
+class DependencyGraph:
+    """Records which sources every cached rendered page was built from.
+
+    Sources are plain strings:
+        file:<path>                 a page source file (city.html, about.html, ...)
+        field:<path>#<key>          a single field of a JSON file ('#*' = every field)
+        city:<state>:<city-slug>    one city row of the database
+        state:<state>               the city list and name of a state
+        zips:<city name>            the zip code index entry of a city name
+        db:states                   the list of states
+    """
+    def __init__(self):
+        self._sources_by_page = {}
+        self._pages_by_source = {}
+        self._lock = threading.Lock()
+
+    def record(self, page_key, sources):
+        with self._lock:
+            self._forget(page_key)
+            self._sources_by_page[page_key] = frozenset(sources)
+            for source in sources:
+                self._pages_by_source.setdefault(source, set()).add(page_key)
+
+    def forget(self, page_key):
+        with self._lock:
+            self._forget(page_key)
+
+    def _forget(self, page_key):
+        for source in self._sources_by_page.pop(page_key, ()):
+            pages = self._pages_by_source.get(source)
+            if pages is not None:
+                pages.discard(page_key)
+                if not pages:
+                    del self._pages_by_source[source]
+
+    def dependents(self, sources):
+        """Return every page key built from at least one of the given sources"""
+        with self._lock:
+            pages = set()
+            for source in sources:
+                pages.update(self._pages_by_source.get(source, ()))
+            return pages
+
+    def pages(self):
+        with self._lock:
+            return set(self._sources_by_page)
+
+dependency_graph = DependencyGraph()
+
+# Rendered pages, partitioned by domain (see PAGE_CACHE_DOMAIN_BUDGET)
+page_cache = PartitionedCache(
+    app.config['PAGE_CACHE_DOMAIN_BUDGET'],
+    app.config['PAGE_CACHE_OVERFLOW_BYTES'],
+    budgets=app.config['PAGE_CACHE_DOMAIN_BUDGETS'],
+    timeout=app.config['PAGE_CACHE_TIMEOUT'],
+    # Pages dropped by the cache itself must not keep their dependency records
+    on_evict=dependency_graph.forget
+)
+
+# Endpoints whose rendered output is cached and tracked in the dependency graph
+CACHED_PAGE_ENDPOINTS = ('handle_home', 'handle_page')
+
+def page_cache_key():
+    return f"page:{request.scheme}://{request.host.lower()}{request.path}"
+
+def source_file(source):
+    """File path of a file: or field: dependency source, None for database sources"""
+    kind, _, rest = source.partition(':')
+    if kind == 'file':
+        return rest
+    if kind == 'field':
+        return rest.rpartition('#')[0]
+    return None
+
+def track_dependency(*sources):
+    """Record sources used while rendering the current page (no-op outside page renders)"""
+    dependencies = g.get('page_dependencies')
+    if dependencies is not None:
+        dependencies.update(sources)
+        stamps = g.page_file_stamps
+        for source in sources:
+            path = source_file(source)
+            # Loaders record the exact version they read, this covers files that are
+            # only checked for existence (e.g. a service's own page)
+            if path is not None and path not in stamps:
+                stamps[path] = file_stamp(path)
+
+def json_field_digests(path, stamp, keys):
+    """((key, digest of its value), ...) of a version of a JSON file, digest None for a missing key"""
+    try:
+        data = _load_json(path, stamp) if stamp is not None else None
+    except (OSError, ValueError):
+        data = None
+    digests = []
+    for key in sorted(keys):
+        if isinstance(data, dict) and key in data:
+            value = json.dumps(data[key], sort_keys=True).encode('utf-8')
+            digests.append((key, hashlib.sha1(value).hexdigest()))
+        else:
+            digests.append((key, None))
+    return tuple(digests)
+
+def page_source_versions(dependencies, stamps):
+    """Versions of the files a page was built from, checked by page_is_current.
+
+    (path, stamp, None) for a file used as a whole (file: or field:...#*), and
+    (path, stamp, field digests) for a JSON file of which only some fields were
+    read, so edits of other fields keep the page. Files that were loaded but
+    not read from are left out.
+    """
+    whole = set()
+    fields = {}
+    for source in dependencies:
+        kind, _, rest = source.partition(':')
+        if kind == 'file':
+            whole.add(rest)
+        elif kind == 'field':
+            path, _, key = rest.rpartition('#')
+            if key == '*':
+                whole.add(path)
+            else:
+                fields.setdefault(path, set()).add(key)
+    versions = [(path, stamps.get(path), None) for path in whole]
+    for path, keys in fields.items():
+        if path not in whole:
+            stamp = stamps.get(path)
+            versions.append((path, stamp, json_field_digests(path, stamp, keys)))
+    return tuple(versions)
+
+def page_is_current(versions):
+    """True if none of the files (or JSON fields) a cached page was built from changed since it was rendered"""
+    for path, stamp, fields in versions:
+        current = file_stamp(path)
+        if current == stamp:
+            continue
+        if fields is None or json_field_digests(path, current, (key for key, _ in fields)) != fields:
+            return False
+    return True
+
+def invalidate_pages(page_keys):
+    """Drop cached rendered pages and their dependency records, return how many were dropped"""
+    page_keys = list(page_keys)
+    if page_keys:
+        page_cache.delete_many(*page_keys)
+    for page_key in page_keys:
+        dependency_graph.forget(page_key)
+    return len(page_keys)
+
+def invalidate_dependents(sources):
+    """Invalidate every cached page that depends on one of the given sources"""
+    invalidated = invalidate_pages(dependency_graph.dependents(sources))
+    if invalidated:
+        print(f"DEBUG: Invalidated {invalidated} rendered pages depending on {sorted(sources)}")
+    return invalidated
+
+def changed_json_fields(old_data, new_data):
+    """Return the top-level keys whose values differ between two JSON objects"""
+    if not isinstance(old_data, dict) or not isinstance(new_data, dict):
+        return {'*'}
+    return {key for key in set(old_data) | set(new_data) if old_data.get(key) != new_data.get(key)}
+
+
+class TrackedDict(dict):
+    """dict that records which keys are read while a page is rendered"""
+    def __init__(self, data, source):
+        super().__init__(data)
+        self.source = source
+
+    def _track(self, key):
+        track_dependency(f"field:{self.source}#{key}")
+
+    def get(self, key, default=None):
+        self._track(key)
+        return super().get(key, default)
+
+    def __getitem__(self, key):
+        self._track(key)
+        return super().__getitem__(key)
+
+    def __iter__(self):
+        self._track('*')
+        return super().__iter__()
+
+    def items(self):
+        self._track('*')
+        return super().items()
+
+    def keys(self):
+        self._track('*')
+        return super().keys()
+
+    def values(self):
+        self._track('*')
+        return super().values()
 
 def get_main_domain():
     host = request.host
     main_domain = ".".join(host.split('.')[-2:])
     return main_domain
 
+def domain_services(required_data):
+    """Service names of a domain: 'main-service' in required.json is one name or a list of names"""
+    services = required_data.get('main-service', '')
+    if isinstance(services, str):
+        services = [services]
+    return [str(service) for service in services if service]
+
+def primary_service(required_data, default=''):
+    """The first service of a domain, used where a page is not about one service"""
+    services = domain_services(required_data)
+    return services[0] if services else default
+
+def service_slug(service_name):
+    return service_name.lower().replace(' ', '-')
+
+def service_name_for(required_data, slug):
+    """The service name from required.json whose slug parse_subdomain matched"""
+    for service in domain_services(required_data):
+        if service_slug(service) == slug:
+            return service
+    return slug
+
+class ServiceTrie:
+    """Character trie of a domain's service slugs for longest-prefix subdomain matching"""
+    def __init__(self, slugs):
+        self._root = {}
+        for slug in slugs:
+            node = self._root
+            for char in slug:
+                node = node.setdefault(char, {})
+            node[None] = slug
+
+    def match(self, label):
+        """Longest slug s with label == s + '-' + city (city non-empty), in O(len(label))"""
+        node = self._root
+        best = None
+        for i, char in enumerate(label):
+            if char == '-' and None in node and i + 1 < len(label):
+                best = node[None]
+            node = node.get(char)
+            if node is None:
+                break
+        return best
+
+# Tries keyed by the tuple of service slugs, so an edited required.json gets a new one
+service_tries = BoundedCache(1024)
+
+def service_page_path(main_domain, service, filename):
+    """domains/<domain>/services/<service>/<filename> if the service has its own page, else the domain's"""
+    service_path = f"domains/{main_domain}/services/{service}/{filename}"
+    # Uploading the service's own version must invalidate pages built from the domain's
+    track_dependency(f"file:{service_path}")
+    if os.path.exists(service_path):
+        return service_path
+    return f"domains/{main_domain}/{filename}"
+
 def parse_subdomain():
     """Parse the subdomain to extract main_service, city, and state using regex.
     
     The format is: service-slug-city-slug-state
     Where:
-    - service-slug: must exactly match the slugified 'main-service' from required.json
+    - service-slug: must exactly match a slugified 'main-service' from required.json
+      (one name or a list of names; the longest matching service wins)
     - city-slug: the city name with hyphens (e.g., new-york)
     - state: two-letter state code (e.g., ny)
     
@@ -138,16 +1381,23 @@ def parse_subdomain():
         with open(required_path, 'r') as f:
             required_data = json.load(f)
         
-        # Normalize case for expected service
-        expected_service = required_data.get('main-service', '').lower().replace(' ', '-')
+        track_dependency(f"field:{required_path}#main-service")
+
+        # Normalize case for the expected services
+        service_slugs = tuple(service_slug(service) for service in domain_services(required_data))
         
-        if not expected_service:
+        if not service_slugs:
             print(f"DEBUG: No 'main-service' defined in required.json")
             return None, None, None
     
-        # Check if the subdomain starts with the expected service
-        if not remaining.startswith(expected_service + '-'):
-            print(f"DEBUG: Subdomain '{subdomain}' doesn't start with expected service '{expected_service}-'")
+        # Find the longest service the subdomain starts with
+        trie = service_tries.get(service_slugs)
+        if trie is None:
+            trie = ServiceTrie(service_slugs)
+            service_tries.set(service_slugs, trie)
+        expected_service = trie.match(remaining)
+        if expected_service is None:
+            print(f"DEBUG: Subdomain '{subdomain}' doesn't start with any expected service {list(service_slugs)}")
             return None, None, None
             
         # Extract the city part (everything between service and state)
@@ -162,6 +1412,250 @@ def parse_subdomain():
     
     # The rest of the function has been replaced by the new implementation above
 
+class SingleFlight:
+    """Coalesce concurrent work on the same key: the first caller leads, later callers wait.
+
+    The leader publishes its result (or error) with finish(); every waiter that
+    joined the flight before that receives the same result.
+    """
+    class Flight:
+        def __init__(self, key):
+            self.key = key
+            self.done = threading.Event()
+            self.waiters = 0
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """Return (flight, is_leader) for key"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = SingleFlight.Flight(key)
+                return flight, True
+            flight.waiters += 1
+            return flight, False
+
+    def finish(self, flight, result=None, error=None):
+        """Publish the leader's result and close the flight; later calls are ignored"""
+        with self._lock:
+            if flight.done.is_set():
+                return
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            flight.result = result
+            flight.error = error
+            flight.done.set()
+
+    def __len__(self):
+        return len(self._flights)
+
+page_flights = SingleFlight()
+coalesce_stats = {'leaders': 0, 'coalesced': 0, 'timeouts': 0, 'errors': 0}
+
+def wait_for_page_flight(key):
+    """Join the render of key; return the leader's response for a waiter, else None.
+
+    The leader keeps the flight in g.page_flight and finishes it in
+    store_rendered_page (or finish_page_flight if the request fails).
+    """
+    flight, leader = page_flights.join(key)
+    if leader:
+        coalesce_stats['leaders'] += 1
+        g.page_flight = flight
+        return None
+    if not flight.done.wait(app.config['COALESCE_TIMEOUT']):
+        coalesce_stats['timeouts'] += 1
+        print(f"DEBUG: Coalesced render of {key} timed out, rendering it again")
+        return None
+    if flight.error is not None:
+        coalesce_stats['errors'] += 1
+        raise RuntimeError(f"Coalesced render of {key} failed: {flight.error}")
+    if flight.result is None:
+        # the leader's response could not be shared, render independently
+        return None
+    coalesce_stats['coalesced'] += 1
+    body, status, headers = flight.result
+    response = Response(body, status=status, headers=headers)
+    response.headers['X-Cache'] = 'COALESCED'
+    return response
+
+def get_cached_page(key, count=True):
+    """Cached (body, mimetype, source versions) of a page, None if missing or built from changed files"""
+    cached = page_cache.get(get_main_domain(), key, count=count)
+    if cached is not None and not page_is_current(cached[2]):
+        # Updated through another worker or edited on disk, render it again
+        print(f"DEBUG: Cached page {key} is stale, a source file changed")
+        invalidate_pages([key])
+        return None
+    return cached
+
+@app.before_request
+def serve_cached_page():
+    """Serve a rendered page from cache, or start tracking the dependencies of a new render"""
+    if database_watcher is None:
+        start_database_watcher()
+    if request.method != 'GET' or request.endpoint not in CACHED_PAGE_ENDPOINTS:
+        return
+    key = page_cache_key()
+    # Profiled requests always render so the profile shows the real pipeline
+    profiling = request.environ.get('app.profiling')
+    cached = None if profiling else get_cached_page(key)
+    if cached is None and not profiling and app.config['COALESCE_RENDERS']:
+        coalesced = wait_for_page_flight(key)
+        if coalesced is not None:
+            return coalesced
+        if g.get('page_flight') is not None:
+            # the previous leader may have cached the page since our lookup
+            cached = get_cached_page(key, count=False)
+    if cached is not None:
+        body, mimetype, _ = cached
+        response = Response(body, mimetype=mimetype)
+        if g.get('page_flight') is not None:
+            # Answer the waiters from the cached page instead of leaving each one to render it
+            page_flights.finish(g.pop('page_flight'), (body, 200, [('Content-Type', response.content_type)]))
+        response.headers['X-Cache'] = 'HIT'
+        return response
+    g.page_key = key
+    g.page_dependencies = set()
+    g.page_file_stamps = {}
+
+@app.after_request
+def store_rendered_page(response):
+    """Cache a freshly rendered page together with the sources it was built from"""
+    key = g.get('page_key')
+    if key is None:
+        return response
+    dependencies = g.get('page_dependencies')
+    flight = g.pop('page_flight', None)
+    if flight is not None and flight.waiters and response.is_streamed:
+        # Waiters need the whole body, so materialize the stream once for everyone
+        response.get_data()
+    if response.status_code == 200 and dependencies:
+        versions = page_source_versions(dependencies, g.page_file_stamps)
+        if response.is_streamed:
+            # Cached once the last chunk went out, so later requests are hits, not cold renders
+            response.response = cache_streamed_page(response.response, get_main_domain(), key,
+                                                    response.mimetype, versions, dependencies)
+        else:
+            cache_rendered_page(get_main_domain(), key, response.get_data(), response.mimetype,
+                                versions, dependencies)
+    response.headers['X-Cache'] = 'MISS'
+    if flight is not None:
+        result = None
+        if not response.is_streamed and not g.get('admission_rejected'):
+            headers = [(name, value) for name, value in response.headers
+                       if name not in ('X-Cache', 'Content-Length', 'Set-Cookie')]
+            result = (response.get_data(), response.status_code, headers)
+        page_flights.finish(flight, result)
+    return response
+
+def cache_rendered_page(domain, key, body, mimetype, versions, dependencies):
+    if page_cache.set(domain, key, (body, mimetype, versions), len(body) + len(key)):
+        dependency_graph.record(key, dependencies)
+    else:
+        dependency_graph.forget(key)
+
+def cache_streamed_page(chunks, domain, key, mimetype, versions, dependencies):
+    """Pass the chunks of a streamed page through and cache the joined body when the stream completes"""
+    body = []
+    for chunk in chunks:
+        body.append(chunk)
+        yield chunk
+    cache_rendered_page(domain, key, b''.join(body), mimetype, versions, dependencies)
+
+@app.teardown_request
+def finish_page_flight(exc=None):
+    """Release waiters of a render that ended without reaching store_rendered_page"""
+    flight = g.pop('page_flight', None)
+    if flight is not None:
+        page_flights.finish(flight, error=exc or RuntimeError("no response was produced"))
+
+class TokenBucketLimiter:
+    """Token buckets keyed by an arbitrary string, held in a bounded LRU"""
+    def __init__(self, rate, burst, max_keys):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = BoundedCache(max_keys)
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Take one token; return 0 if allowed, else the seconds until a token is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._buckets.set(key, (tokens - 1, now))
+                return 0
+            self._buckets.set(key, (tokens, now))
+            return (1 - tokens) / self.rate
+
+BOT_USER_AGENT_PATTERN = re.compile(r'bot|crawl|spider|slurp|fetch|scrape|curl|wget|python-requests|httpclient', re.IGNORECASE)
+
+client_limiter = TokenBucketLimiter(app.config['ADMISSION_CLIENT_RATE'], app.config['ADMISSION_CLIENT_BURST'],
+                                    app.config['ADMISSION_MAX_TRACKED_KEYS'])
+domain_limiter = TokenBucketLimiter(app.config['ADMISSION_DOMAIN_RATE'], app.config['ADMISSION_DOMAIN_BURST'],
+                                    app.config['ADMISSION_MAX_TRACKED_KEYS'])
+cold_render_slots = threading.BoundedSemaphore(app.config['ADMISSION_MAX_COLD_RENDERS'])
+bot_render_slots = threading.BoundedSemaphore(app.config['ADMISSION_BOT_MAX_COLD_RENDERS'])
+admission_stats = {'admitted': 0, 'rate_limited': 0, 'saturated': 0}
+admission_stats_lock = threading.Lock()
+
+def count_admission(outcome):
+    with admission_stats_lock:
+        admission_stats[outcome] += 1
+
+def get_client_ip():
+    return request.headers.get('X-Real-IP') or request.remote_addr or ''
+
+def is_bot_request():
+    return bool(BOT_USER_AGENT_PATTERN.search(request.headers.get('User-Agent', '')))
+
+def admission_rejected(status, retry_after):
+    """Cheap plain-text rejection with a Retry-After header"""
+    count_admission('rate_limited' if status == 429 else 'saturated')
+    g.admission_rejected = True
+    message = "Too Many Requests" if status == 429 else "Service Temporarily Unavailable"
+    response = Response(message, status=status, mimetype='text/plain')
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+@app.before_request
+def admit_cold_render():
+    """Rate limit and bound the concurrency of page renders that missed the page cache"""
+    if g.get('page_key') is None or not app.config['ADMISSION_ENABLED']:
+        return
+    bot = is_bot_request()
+
+    retry_after = client_limiter.take(get_client_ip())
+    if not retry_after and bot:
+        retry_after = domain_limiter.take(get_main_domain())
+    if retry_after:
+        return admission_rejected(429, retry_after)
+
+    if bot:
+        if not bot_render_slots.acquire(blocking=False):
+            return admission_rejected(503, 1)
+        if not cold_render_slots.acquire(blocking=False):
+            bot_render_slots.release()
+            return admission_rejected(503, 1)
+        g.admission_slots = (cold_render_slots, bot_render_slots)
+    else:
+        if not cold_render_slots.acquire(timeout=app.config['ADMISSION_QUEUE_TIMEOUT']):
+            return admission_rejected(503, 1)
+        g.admission_slots = (cold_render_slots,)
+    count_admission('admitted')
+
+@app.teardown_request
+def release_cold_render(exc=None):
+    for slot in g.pop('admission_slots', ()):
+        slot.release()
+
 # Before request middleware to load required.json
 @app.before_request
 def load_required_json():
@@ -175,7 +1669,7 @@ def load_required_json():
     
     try:
         required_data = load_json(required_path)
-        request.required_data = required_data
+        request.required_data = TrackedDict(required_data, required_path)
     except Exception as e:
         print(f"Error loading required.json: {e}")
         request.required_data = {}
@@ -183,27 +1677,61 @@ def load_required_json():
     # Add the main domain to the request for easy access
     request.main_domain = main_domain
 
-def replace_placeholders(text, service_name, city_name, state_abbreviation, state_full_name, required_data, zip_codes=[], city_zip_code=""):
-    """Replace placeholders and process spintax in HTML content"""
-    
-    # First, protect regular script and style tags from all replacements
+# Placeholders in the order they are replaced
+PLACEHOLDER_NAMES = (
+    "[Service]", "[service]", "[City-State]", "[city-state]", "[City]", "[city]", "[CITY]",
+    "[State]", "[state]", "[STATE]", "[State Full]", "[Zipcode]", "[City Zip Code]", "[Zip Codes]",
+    "[Company Name]", "[Phone]", "[Email]", "[Address]", "[Canonical URL]"
+)
+# Placeholders whose value is the same for every page of a domain
+DOMAIN_PLACEHOLDERS = ("[Service]", "[service]", "[Company Name]", "[Phone]", "[Email]", "[Address]")
+PLACEHOLDER_PATTERN = re.compile('|'.join(re.escape(name) for name in PLACEHOLDER_NAMES))
+
+REGULAR_TAG_PATTERN = re.compile(r'(<(style|script)(?![^>]*type="application/ld\+json")[^>]*>.*?</\2>)', re.DOTALL)
+SCHEMA_PATTERN = re.compile(r'(<script[^>]*type="application/ld\+json"[^>]*>)(.*?)(</script>)', re.DOTALL)
+BLOCK_MARKER_PATTERN = re.compile(r'__(FULLY_PROTECTED|SCHEMA)_BLOCK_(\d+)__')
+
+def placeholder_values(service_name, city_name, state_abbreviation, state_full_name, required_data, zip_codes=[], city_zip_code=""):
+    """Values for every placeholder, in replacement order"""
+    return {
+        "[Service]": service_name,
+        "[service]": service_name.lower(),
+        "[City-State]": f"{city_name}, {state_abbreviation}",
+        "[city-state]": f"{city_name.lower()}, {state_abbreviation.lower()}",
+        "[City]": city_name,
+        "[city]": city_name.lower(),
+        "[CITY]": city_name.upper(),
+        "[State]": state_abbreviation,
+        "[state]": state_abbreviation.lower(),
+        "[STATE]": state_abbreviation.upper(),
+        "[State Full]": state_full_name,
+        "[Zipcode]": city_zip_code,  # Add new format
+        "[City Zip Code]": city_zip_code,
+        "[Zip Codes]": ", ".join(str(z) for z in zip_codes if z),
+        "[Company Name]": required_data.get("Business Name", "N/A"),
+        "[Phone]": required_data.get("Phone", "N/A"),
+        "[Email]": required_data.get("Business Email", "N/A"),
+        "[Address]": required_data.get("Business Address", "N/A"),
+        "[Canonical URL]": get_canonical_url()  # Add canonical URL placeholder
+    }
+
+def protect_blocks(text):
+    """Swap script/style tags and JSON-LD schema blocks for __*_BLOCK_n__ markers.
+
+    Returns (text, fully_protected_blocks, schema_blocks). Regular script and style
+    tags are excluded from all replacements, schema blocks only from spintax.
+    """
     fully_protected_blocks = []
     
-    # Extract and replace regular script and style tags (excluding JSON-LD schema)
-    regular_tag_pattern = r'(<(style|script)(?![^>]*type="application/ld\+json")[^>]*>.*?</\2>)'
-    
     def save_fully_protected_tag(match):
         entire_tag = match.group(1)
         fully_protected_blocks.append(entire_tag)
         return f"__FULLY_PROTECTED_BLOCK_{len(fully_protected_blocks)-1}__"
     
     # Replace regular script and style tags with placeholders
-    text = re.sub(regular_tag_pattern, save_fully_protected_tag, text, flags=re.DOTALL)
+    text = REGULAR_TAG_PATTERN.sub(save_fully_protected_tag, text)
     
-    # Now handle JSON-LD schema blocks separately - we'll protect them from spintax
-    # but allow placeholder replacements
     schema_blocks = []
-    schema_pattern = r'(<script[^>]*type="application/ld\+json"[^>]*>)(.*?)(</script>)'
     
     def save_schema_block(match):
         opening = match.group(1)
@@ -213,92 +1741,38 @@ def replace_placeholders(text, service_name, city_name, state_abbreviation, stat
         return f"__SCHEMA_BLOCK_{len(schema_blocks)-1}__"
     
     # Replace schema blocks with placeholders
-    text = re.sub(schema_pattern, save_schema_block, text, flags=re.DOTALL)
-    
-    # Process spintax
-    pattern = r'\{([^}]*)\}'
-    
-    # Generate a consistent seed for this city-state pair
-    city_state_key = f"{city_name}|{state_abbreviation}"
-    
-    # Check if we already have a seed for this city-state pair
-    if city_state_key not in spintax_seed_cache:
-        # Create a reproducible seed by hashing the city-state key
-        hash_obj = hashlib.md5(city_state_key.encode())
-        seed_value = int(hash_obj.hexdigest(), 16) % (2**32)  # Convert to a 32-bit integer
-        spintax_seed_cache[city_state_key] = seed_value
-    
-    # Get the seed for this city-state pair
-    seed = spintax_seed_cache[city_state_key]
+    text = SCHEMA_PATTERN.sub(save_schema_block, text)
+    return text, fully_protected_blocks, schema_blocks
+
+def replace_placeholders(text, service_name, city_name, state_abbreviation, state_full_name, required_data, zip_codes=[], city_zip_code=""):
+    """Replace placeholders and process spintax in HTML content"""
     
-    # Create a random generator with the consistent seed
-    rng = random.Random(seed)
+    # First, protect regular script and style tags from all replacements, and
+    # JSON-LD schema blocks from spintax
+    text, fully_protected_blocks, schema_blocks = protect_blocks(text)
     
-    def random_replacer(match):
-        options = match.group(1).split('|')
-        return rng.choice(options)
-        
     # Step 1: Replace random choice patterns with consistent choices
-    text = re.sub(pattern, random_replacer, text)
+    text = resolve_spintax(text, f"{city_name}|{state_abbreviation}")
 
     # Step 2: Replace placeholders
-    replacements = {
-        "[Service]": service_name,
-        "[service]": service_name.lower(),
-        "[City-State]": f"{city_name}, {state_abbreviation}",
-        "[city-state]": f"{city_name.lower()}, {state_abbreviation.lower()}",
-        "[City]": city_name,
-        "[city]": city_name.lower(),
-        "[CITY]": city_name.upper(),
-        "[State]": state_abbreviation,
-        "[state]": state_abbreviation.lower(),
-        "[STATE]": state_abbreviation.upper(),
-        "[State Full]": state_full_name,
-        "[Zipcode]": city_zip_code,  # Add new format
-        "[City Zip Code]": city_zip_code,
-        "[Zip Codes]": ", ".join(str(z) for z in zip_codes if z),
-        "[Company Name]": required_data.get("Business Name", "N/A"),
-        "[Phone]": required_data.get("Phone", "N/A"),
-        "[Email]": required_data.get("Business Email", "N/A"),
-        "[Address]": required_data.get("Business Address", "N/A"),
-        "[Canonical URL]": get_canonical_url()  # Add canonical URL placeholder
-    }
+    replacements = placeholder_values(
+        service_name, city_name, state_abbreviation, state_full_name, required_data, zip_codes, city_zip_code
+    )
     
     for placeholder, value in replacements.items():
         text = text.replace(placeholder, str(value))
-    
+
+    return restore_blocks(text, fully_protected_blocks, schema_blocks, replacements)
+
+def restore_blocks(text, fully_protected_blocks, schema_blocks, replacements):
+    """Put back the blocks swapped out by protect_blocks, with placeholders replaced in schema blocks"""
     # Restore fully protected blocks (regular script and style tags)
     for i, block in enumerate(fully_protected_blocks):
         text = text.replace(f"__FULLY_PROTECTED_BLOCK_{i}__", block)
     
     # Process schema blocks - apply placeholder replacements but not spintax
     for i, (opening, content, closing) in enumerate(schema_blocks):
-        # Apply only placeholder replacements to schema content
         processed_content = content
-        
-        # Apply placeholder replacements to schema content
-        replacements = {
-            "[Service]": service_name,
-            "[service]": service_name.lower(),
-            "[City-State]": f"{city_name}, {state_abbreviation}",
-            "[city-state]": f"{city_name.lower()}, {state_abbreviation.lower()}",
-            "[City]": city_name,
-            "[city]": city_name.lower(),
-            "[CITY]": city_name.upper(),
-            "[State]": state_abbreviation,
-            "[state]": state_abbreviation.lower(),
-            "[STATE]": state_abbreviation.upper(),
-            "[State Full]": state_full_name,
-            "[Zipcode]": city_zip_code,
-            "[City Zip Code]": city_zip_code,
-            "[Zip Codes]": ", ".join(str(z) for z in zip_codes if z),
-            "[Company Name]": required_data.get("Business Name", "N/A"),
-            "[Phone]": required_data.get("Phone", "N/A"),
-            "[Email]": required_data.get("Business Email", "N/A"),
-            "[Address]": required_data.get("Business Address", "N/A"),
-            "[Canonical URL]": get_canonical_url()  # Canonical URL placeholder
-        }
-        
         for placeholder, value in replacements.items():
             processed_content = processed_content.replace(placeholder, str(value))
             
@@ -307,10 +1781,224 @@ def replace_placeholders(text, service_name, city_name, state_abbreviation, stat
         
     return text
 
-def get_db_connection():
-    conn = sqlite3.connect('newcities.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+# Compiled spintax form of a text: literal pieces interleaved with option groups,
+# len(literals) == len(groups) + 1
+SpintaxTemplate = namedtuple('SpintaxTemplate', ['digest', 'literals', 'groups', 'option_counts'])
+SpintaxGroup = namedtuple('SpintaxGroup', ['index', 'options'])
+
+# Spintax syntax: {a|b|c} groups, nested groups {a|{b|c}}, escaped \{ \} \| and Jinja
+# {{ }}, {% %} and {# #} constructs, which pass through untouched
+SPINTAX_TOKEN_PATTERN = re.compile(r'\\[{}|]|\{[{%#]|[{}|]')
+JINJA_CLOSERS = {'{{': '}}', '{%': '%}', '{#': '#}'}
+# Groups without braces inside, the whole syntax of most pages (see _parse_flat_spintax)
+FLAT_SPINTAX_PATTERN = re.compile(r'\{([^{}]*)\}')
+
+spintax_templates = BoundedCache(app.config['SPINTAX_TEMPLATE_CACHE_SIZE'])
+spintax_choices = BoundedCache(app.config['SPINTAX_CHOICE_CACHE_SIZE'])
+
+def _lex_spintax(text):
+    """Split text into ('text', str), ('open',), ('bar',) and ('close',) tokens.
+
+    '{{', '{%' or '{#' starts a Jinja construct, kept as text, only when the first
+    '}' after it belongs to the matching closer; otherwise the '{' opens a group,
+    so {%20 off|sale} and {{a|b}|c} stay spintax. The position of the next '}' is
+    reused until it is passed, so lexing is linear in len(text).
+    """
+    tokens = []
+    position = 0
+    next_close = -1
+    while True:
+        match = SPINTAX_TOKEN_PATTERN.search(text, position)
+        if match is None:
+            break
+        start = match.start()
+        if start > position:
+            tokens.append(('text', text[position:start]))
+        token = match.group(0)
+        position = match.end()
+        if token[0] == '\\':
+            tokens.append(('text', token[1]))
+        elif len(token) == 2:
+            if next_close != -2 and next_close < position:
+                next_close = text.find('}', position)
+                if next_close < 0:
+                    next_close = -2  # no '}' left in the text
+            if token == '{{':
+                end = next_close + 2 if next_close >= 0 and text.startswith('}}', next_close) else -1
+            else:
+                end = next_close + 1 if next_close > position and text[next_close - 1] == token[1] else -1
+            if end >= 0:
+                tokens.append(('text', text[start:end]))
+                position = end
+            else:
+                # not Jinja, the '{' opens a group and the next character is rescanned
+                tokens.append(('open',))
+                position = start + 1
+        else:
+            tokens.append(('open',) if token == '{' else ('close',) if token == '}' else ('bar',))
+    if position < len(text):
+        tokens.append(('text', text[position:]))
+    return tokens
+
+def _merge_text(items):
+    """Join adjacent strings of a list of str and SpintaxGroup items"""
+    merged = []
+    run = []
+    for item in items:
+        if type(item) is str:
+            run.append(item)
+            continue
+        if run:
+            merged.append(''.join(run))
+            run = []
+        merged.append(item)
+    if run:
+        merged.append(''.join(run))
+    return [item for item in merged if item != '']
+
+def parse_spintax(text):
+    """Parse text into top-level items (str or SpintaxGroup) and per-group option counts.
+
+    Braces are matched with a stack first; an unmatched '{' or '}' and a '|'
+    outside any group are literal text. Groups are numbered in document
+    pre-order (the order of their opening braces).
+    """
+    parsed = _parse_flat_spintax(text)
+    if parsed is not None:
+        return parsed
+    return _parse_nested_spintax(text)
+
+def _parse_flat_spintax(text):
+    """parse_spintax for text without escapes, Jinja or nested groups, else None.
+
+    Every {...} without braces inside is a group, which is also what the stack
+    finds unless the braces left over contain a '{' before a '}' (nesting).
+    """
+    if '\\{' in text or '\\}' in text or '\\|' in text or '{{' in text or '{%' in text or '{#' in text:
+        return None
+    items = []
+    option_counts = []
+    position = 0
+    for match in FLAT_SPINTAX_PATTERN.finditer(text):
+        if match.start() > position:
+            items.append(text[position:match.start()])
+        options = tuple((option,) if option else () for option in match.group(1).split('|'))
+        items.append(SpintaxGroup(len(option_counts), options))
+        option_counts.append(len(options))
+        position = match.end()
+    if position < len(text):
+        items.append(text[position:])
+    leftover = ''.join(item for item in items if type(item) is str)
+    opening = leftover.find('{')
+    if opening >= 0 and leftover.find('}', opening) >= 0:
+        return None
+    return items, tuple(option_counts)
+
+def _parse_nested_spintax(text):
+    tokens = _lex_spintax(text)
+    matched = set()
+    stack = []
+    for i, token in enumerate(tokens):
+        if token[0] == 'open':
+            stack.append(i)
+        elif token[0] == 'close' and stack:
+            matched.add(stack.pop())
+            matched.add(i)
+
+    option_counts = []
+    top = []
+    frames = []  # [index, finished options, current option items]
+    for i, token in enumerate(tokens):
+        kind = token[0]
+        items = frames[-1][2] if frames else top
+        if kind == 'text':
+            items.append(token[1])
+        elif kind == 'open' and i in matched:
+            frames.append([len(option_counts), [], []])
+            option_counts.append(0)
+        elif kind == 'close' and i in matched:
+            index, options, current = frames.pop()
+            options.append(tuple(_merge_text(current)))
+            option_counts[index] = len(options)
+            (frames[-1][2] if frames else top).append(SpintaxGroup(index, tuple(options)))
+        elif kind == 'bar' and frames:
+            frames[-1][1].append(tuple(_merge_text(items)))
+            frames[-1][2] = []
+        else:
+            items.append('{' if kind == 'open' else '}' if kind == 'close' else '|')
+    return _merge_text(top), tuple(option_counts)
+
+def compile_spintax(text):
+    """Split text into top-level literals and spintax groups, cached by content hash"""
+    digest = hashlib.md5(text.encode('utf-8')).digest()
+    compiled = spintax_templates.get(digest)
+    if compiled is None:
+        items, option_counts = parse_spintax(text)
+        literals = ['']
+        groups = []
+        for item in items:
+            # items alternate between merged text and groups
+            if type(item) is str:
+                literals[-1] = item
+            else:
+                groups.append(item)
+                literals.append('')
+        compiled = SpintaxTemplate(digest, tuple(literals), tuple(groups), option_counts)
+        spintax_templates.set(digest, compiled)
+    return compiled
+
+def spintax_option_text(option):
+    """The text of an option without nested groups, or None if it has some"""
+    if any(type(item) is not str for item in option):
+        return None
+    return ''.join(option)
+
+def get_spintax_choices(compiled, city_state_key):
+    """Return the chosen option index for every group of a compiled text and city.
+
+    Choices are drawn from random.Random(seed) for every group in document
+    pre-order, nested groups included, so they match rng.choice(options)
+    applied group by group. They are stored compactly as an
+    array of indices, and only for city-state keys that exist in the database.
+    """
+    seed = db_cache.spintax_seeds.get(city_state_key)
+    cacheable = seed is not None
+    if cacheable:
+        choices = spintax_choices.get((compiled.digest, city_state_key))
+        if choices is not None:
+            return choices
+    else:
+        seed = spintax_seed(city_state_key)
+
+    rng = random.Random(seed)
+    indices = [rng.choice(range(count)) for count in compiled.option_counts]
+    typecode = 'H' if all(count <= 0xFFFF for count in compiled.option_counts) else 'I'
+    choices = array(typecode, indices)
+    if cacheable:
+        spintax_choices.set((compiled.digest, city_state_key), choices)
+    return choices
+
+def resolve_spintax(text, city_state_key):
+    """Replace every {a|b|c} group with the consistent choice for this city-state pair"""
+    compiled = compile_spintax(text)
+    if not compiled.groups:
+        return compiled.literals[0]
+    choices = get_spintax_choices(compiled, city_state_key)
+    parts = [compiled.literals[0]]
+    for group, literal in zip(compiled.groups, compiled.literals[1:]):
+        # Walk the chosen options with an explicit stack, nesting depth is unbounded
+        stack = [iter(group.options[choices[group.index]])]
+        while stack:
+            for item in stack[-1]:
+                if type(item) is str:
+                    parts.append(item)
+                else:
+                    stack.append(iter(item.options[choices[item.index]]))
+                    break
+            else:
+                stack.pop()
+        parts.append(literal)
+    return ''.join(parts)
 
 @cache.memoize(timeout=86400)  # Cache for 1 day
 def get_state_full_name(state_abbr):
@@ -338,11 +2026,7 @@ def get_cities_in_state(state_code):
     else:
         print(f"Warning: No cities found for state code '{state_code}' in cache")
         # Try to get cities directly from the database as fallback
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT city_name FROM Cities WHERE LOWER(state_code) = ?", (state_code,))
-        cities = [row['city_name'] for row in cursor.fetchall()]
-        conn.close()
+        cities = query_cities_in_state(state_code)
         
         # Update the cache for future requests
         if cities:
@@ -350,24 +2034,346 @@ def get_cities_in_state(state_code):
             
         return sorted(cities)
 
+# Fragment rendering of city pages.
+#
+# Most of a city page is identical for every city of a domain. A page source is
+# compiled once per domain into byte segments: static bytes (markup, protected
+# blocks, domain-level placeholders already substituted) and slots for city-level
+# placeholders, spintax choices and the canonical <link> before </head>. A request
+# only renders the slots and joins the cached segments. Pages where this could
+# differ from replace_placeholders (Jinja markers, placeholder-like values, block
+# markers in content, placeholders assembled by spintax) fall back to the full pipeline.
+# Byte budgets of the per-domain fragment cache, partitioned like the page cache
+app.config['PAGE_FRAGMENT_DOMAIN_BUDGET'] = 8 * 1024 * 1024
+app.config['PAGE_FRAGMENT_DOMAIN_BUDGETS'] = {}
+app.config['PAGE_FRAGMENT_OVERFLOW_BYTES'] = 32 * 1024 * 1024
+# Pages with at least this many static bytes are streamed in chunks instead of built in one piece
+app.config['STREAM_MIN_BYTES'] = 64 * 1024
+app.config['STREAM_CHUNK_SIZE'] = 16 * 1024
+
+PageFragments = namedtuple('PageFragments', ['digest', 'parts', 'spintax', 'city_placeholders',
+                                             'has_head', 'has_canonical', 'static_bytes'])
+
+# Strings the routes look for in rendered output; they must never span a segment boundary
+FRAGMENT_MARKERS = ("{% for", "{{ ", "<head>", "</head>", 'rel="canonical"')
+# Values substituted into slots must not contain these, so markers cannot form inside them
+UNSAFE_VALUE_CHARS = '{[]<"'
+
+page_fragments = PartitionedCache(
+    app.config['PAGE_FRAGMENT_DOMAIN_BUDGET'],
+    app.config['PAGE_FRAGMENT_OVERFLOW_BYTES'],
+    budgets=app.config['PAGE_FRAGMENT_DOMAIN_BUDGETS']
+)
+
+def _unsafe_value(value):
+    return '_BLOCK_' in value or any(char in value for char in UNSAFE_VALUE_CHARS)
+
+def _splits_marker(piece):
+    """True if piece could form a FRAGMENT_MARKER together with neighbouring slots.
+
+    Slot values never contain UNSAFE_VALUE_CHARS, so every unsafe character of a
+    marker has to come from a static piece; only pieces that end with, start with
+    or consist of the part of a marker around such a character are rejected.
+    """
+    for marker in FRAGMENT_MARKERS:
+        for i in range(1, len(marker)):
+            prefix, suffix = marker[:i], marker[i:]
+            if _unsafe_value(prefix) and piece.endswith(prefix):
+                return True
+            if not _unsafe_value(prefix) and piece.startswith(suffix):
+                return True
+        if piece and piece in marker[1:-1] and _unsafe_value(piece):
+            return True
+    return False
+
+def _splits_placeholder(piece):
+    """True if piece could form a [Placeholder] together with neighbouring slots.
+
+    Slot values never contain '[' or ']', so a placeholder spanning a slot, as in
+    '[{City|City}]', needs a static piece ending with its opening part or
+    starting with its closing part.
+    """
+    head, bracket, _ = piece.partition(']')
+    if bracket and '[' not in head and any(name.endswith(head + ']') for name in PLACEHOLDER_NAMES):
+        return True
+    opening = piece.rfind('[')
+    return opening > piece.rfind(']') and any(name.startswith(piece[opening:]) for name in PLACEHOLDER_NAMES)
+
+def _tokenize_placeholders(text, domain_values, out):
+    """Append the static text and ('ph', name) slots of text to out"""
+    position = 0
+    for match in PLACEHOLDER_PATTERN.finditer(text):
+        out.append(text[position:match.start()])
+        name = match.group(0)
+        out.append(domain_values[name] if name in domain_values else ('ph', name))
+        position = match.end()
+    out.append(text[position:])
+
+def _merge_static(parts):
+    """Join adjacent static strings, leaving slots in place"""
+    merged = []
+    for part in parts:
+        if isinstance(part, str):
+            if not part:
+                continue
+            if merged and isinstance(merged[-1], str):
+                merged[-1] += part
+                continue
+        merged.append(part)
+    return merged
+
+# Sentinel stored for sources that can never be fragment-rendered
+NOT_FRAGMENTABLE = ()
+
+def tokenize_page_source(source):
+    """Split a page source into static text, placeholder slots and spintax slots.
+
+    This part does not depend on the domain, so it is stored once per content digest.
+    Returns (parts, spintax), or NOT_FRAGMENTABLE if the page needs the full pipeline.
+    """
+    marked, fully_protected_blocks, schema_blocks = protect_blocks(source)
+    if any('_BLOCK_' in block for block in fully_protected_blocks) or \
+            any('_BLOCK_' in content for _, content, _ in schema_blocks):
+        return NOT_FRAGMENTABLE
+    spintax = compile_spintax(marked)
+
+    parts = []
+    for position, literal in enumerate(spintax.literals):
+        if position:
+            group = spintax.groups[position - 1]
+            options = []
+            for option in group.options:
+                option = spintax_option_text(option)
+                if option is None or '_BLOCK_' in option:
+                    # nested groups are left to the full pipeline
+                    return NOT_FRAGMENTABLE
+                option_parts = []
+                _tokenize_placeholders(option, {}, option_parts)
+                options.append(tuple(option_parts))
+            parts.append(('spin', group.index, tuple(options)))
+
+        offset = 0
+        for match in BLOCK_MARKER_PATTERN.finditer(literal):
+            kind, index = match.group(1), int(match.group(2))
+            blocks = fully_protected_blocks if kind == 'FULLY_PROTECTED' else schema_blocks
+            if index >= len(blocks):
+                continue
+            _tokenize_placeholders(literal[offset:match.start()], {}, parts)
+            if kind == 'FULLY_PROTECTED':
+                parts.append(blocks[index])
+            else:
+                opening, content, closing = blocks[index]
+                parts.append(opening)
+                _tokenize_placeholders(content, {}, parts)
+                parts.append(closing)
+            offset = match.end()
+        _tokenize_placeholders(literal[offset:], {}, parts)
+    return tuple(_merge_static(parts)), spintax
+
+def _bind_domain_values(parts, domain_values):
+    """Substitute domain-level placeholder slots with their values and merge static text"""
+    return _merge_static([
+        domain_values.get(part[1], part) if isinstance(part, tuple) and part[0] == 'ph' else part
+        for part in parts
+    ])
+
+def compile_page_fragments(digest, tokens, domain_values):
+    """Bind the tokens of a page source to one domain's values, or None if not eligible"""
+    if tokens is NOT_FRAGMENTABLE or any(_unsafe_value(value) for value in domain_values.values()):
+        return None
+    token_parts, spintax = tokens
+
+    parts = []
+    for part in _bind_domain_values(token_parts, domain_values):
+        if isinstance(part, tuple) and part[0] == 'spin':
+            part = ('spin', part[1], [_bind_domain_values(option, domain_values) for option in part[2]])
+        parts.append(part)
+
+    # Every static string, including spintax options, must be safe to cut at slot boundaries
+    statics = [part for part in parts if isinstance(part, str)]
+    option_statics = [piece for part in parts if isinstance(part, tuple) and part[0] == 'spin'
+                      for option in part[2] for piece in option if isinstance(piece, str)]
+    if any(_splits_marker(piece) or _splits_placeholder(piece) for piece in statics + option_statics):
+        return None
+    if any(marker in piece for piece in option_statics for marker in FRAGMENT_MARKERS):
+        return None
+    if any(marker in piece for piece in statics for marker in FRAGMENT_MARKERS[:2]):
+        # Jinja tags present, the page needs the full render path
+        return None
+
+    # Encode static segments once and expose every </head> as its own slot
+    city_placeholders = set()
+    encoded = []
+    for part in parts:
+        if isinstance(part, str):
+            for i, piece in enumerate(part.split('</head>')):
+                if i:
+                    encoded.append(('head',))
+                if piece:
+                    encoded.append(piece.encode('utf-8'))
+        elif part[0] == 'ph':
+            city_placeholders.add(part[1])
+            encoded.append(part)
+        else:
+            options = []
+            for option in part[2]:
+                option_parts = []
+                for piece in option:
+                    if isinstance(piece, str):
+                        option_parts.append(piece.encode('utf-8'))
+                    else:
+                        city_placeholders.add(piece[1])
+                        option_parts.append(piece)
+                options.append(tuple(option_parts))
+            encoded.append(('spin', part[1], tuple(options)))
+
+    return PageFragments(
+        digest=digest,
+        parts=tuple(encoded),
+        spintax=spintax,
+        city_placeholders=frozenset(city_placeholders),
+        has_head=any('<head>' in piece for piece in statics),
+        has_canonical=any('rel="canonical"' in piece for piece in statics),
+        static_bytes=sum(len(part) for part in encoded if isinstance(part, bytes)),
+    )
+
+def fragments_size(fragments):
+    """Approximate bytes held by a cached PageFragments (None entries cost a key only)"""
+    if fragments is None:
+        return 64
+    return fragments.static_bytes + 64 * len(fragments.parts)
+
+def get_page_fragments(page_path, source, service_name, required_data):
+    """Return the cached PageFragments of a page source for the current domain values"""
+    domain_values = {
+        "[Service]": str(service_name),
+        "[service]": str(service_name.lower()),
+        "[Company Name]": str(required_data.get("Business Name", "N/A")),
+        "[Phone]": str(required_data.get("Phone", "N/A")),
+        "[Email]": str(required_data.get("Business Email", "N/A")),
+        "[Address]": str(required_data.get("Business Address", "N/A")),
+    }
+    digest = html_store.digest_for(page_path)
+    if digest is None:
+        digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    key = (digest,) + tuple(domain_values.values())
+    domain = get_main_domain()
+    fragments = page_fragments.get(domain, key, NOT_FRAGMENTABLE)
+    if fragments is NOT_FRAGMENTABLE:
+        tokens = html_store.artifact(digest, 'fragment-tokens', lambda: load_compiled_tokens(page_path, digest, source))
+        fragments = compile_page_fragments(digest, tokens, domain_values)
+        page_fragments.set(domain, key, fragments, fragments_size(fragments))
+    return fragments
+
+def _page_fragment_slots(fragments, values, canonical_url):
+    """Encode the city-level slot values, or None if one of them is unsafe"""
+    slot_values = {}
+    for name in fragments.city_placeholders:
+        value = str(values[name])
+        if _unsafe_value(value):
+            return None
+        slot_values[name] = value.encode('utf-8')
+
+    head_close = b'</head>'
+    if canonical_url is not None and fragments.has_head and not fragments.has_canonical:
+        if _unsafe_value(canonical_url):
+            return None
+        head_close = f'<link rel="canonical" href="{canonical_url}" />\n</head>'.encode('utf-8')
+    slot_values['</head>'] = head_close
+    return slot_values
+
+def _iter_page_fragments(fragments, slot_values, city_state_key):
+    """Yield (bytes, is_head_close) for every segment of the page in order"""
+    choices = get_spintax_choices(fragments.spintax, city_state_key) if fragments.spintax.groups else ()
+    for part in fragments.parts:
+        if type(part) is bytes:
+            yield part, False
+        elif part[0] == 'ph':
+            yield slot_values[part[1]], False
+        elif part[0] == 'spin':
+            for piece in part[2][choices[part[1]]]:
+                yield (piece if type(piece) is bytes else slot_values[piece[1]]), False
+        else:
+            yield slot_values['</head>'], True
+
+def render_page_fragments(fragments, values, city_state_key, canonical_url=None):
+    """Join the cached segments with the city-level slots, or None if a value is unsafe.
+
+    values holds every placeholder value (see placeholder_values). With canonical_url,
+    a canonical <link> is inserted before </head> the same way handle_page does.
+    """
+    slot_values = _page_fragment_slots(fragments, values, canonical_url)
+    if slot_values is None:
+        return None
+    return b''.join(piece for piece, _ in _iter_page_fragments(fragments, slot_values, city_state_key))
+
+def stream_page_fragments(fragments, values, city_state_key, canonical_url=None):
+    """Like render_page_fragments, but return a generator of chunks.
+
+    Everything up to </head> is flushed as the first chunk so the browser can start
+    fetching CSS and fonts, the rest goes out in chunks of about STREAM_CHUNK_SIZE
+    bytes. Segments are the cached byte strings themselves, so the memory a request
+    holds is bounded by the chunk size rather than the page size.
+    """
+    slot_values = _page_fragment_slots(fragments, values, canonical_url)
+    if slot_values is None:
+        return None
+    chunk_size = app.config['STREAM_CHUNK_SIZE']
+
+    def generate():
+        pending = []
+        pending_size = 0
+        for piece, is_head_close in _iter_page_fragments(fragments, slot_values, city_state_key):
+            pending.append(piece)
+            pending_size += len(piece)
+            if is_head_close or pending_size >= chunk_size:
+                yield b''.join(pending)
+                pending = []
+                pending_size = 0
+        if pending:
+            yield b''.join(pending)
+
+    return generate()
+
+def respond_with_fragments(fragments, values, city_state_key, canonical_url=None):
+    """Build the response body for a fragment-rendered page, streaming large pages.
+
+    Returns None when the page has to go through the full pipeline instead.
+    """
+    if fragments.static_bytes >= app.config['STREAM_MIN_BYTES']:
+        stream = stream_page_fragments(fragments, values, city_state_key, canonical_url)
+        if stream is not None:
+            return Response(stream, mimetype='text/html')
+        return None
+    return render_page_fragments(fragments, values, city_state_key, canonical_url)
+
+def query_cities_in_state(state_code):
+    """Read the city names of a state straight from the database"""
+    if db_pool.schema_version >= 1:
+        sql = "SELECT city_name FROM Cities WHERE state_slug = ?"
+    else:
+        sql = "SELECT city_name FROM Cities WHERE LOWER(state_code) = ?"
+    with db_pool.connection() as conn:
+        return [row['city_name'] for row in conn.execute(sql, (state_code.lower(),))]
+
 def get_city_info(city_subdomain, state_abbr):
     city_subdomain_lower = city_subdomain.lower()
     state_abbr_lower = state_abbr.lower()
     
-    # Convert any hyphens in city_subdomain to spaces
-    city_search = city_subdomain_lower.replace('-', ' ')
-    
-    # Retrieve matching city from database
-    with sqlite3.connect('newcities.db') as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # Try exact match first
-        cursor.execute(
-            "SELECT city_name, state_code, main_zip_code FROM Cities WHERE LOWER(city_name) = ? AND LOWER(state_code) = ?",
-            (city_search, state_abbr_lower)
-        )
-        row = cursor.fetchone()
+    with db_pool.connection() as conn:
+        if db_pool.schema_version >= 1:
+            # Indexed lookup on the normalized slug columns
+            row = conn.execute(
+                "SELECT city_name, main_zip_code FROM Cities WHERE state_slug = ? AND city_slug = ? ORDER BY id LIMIT 1",
+                (state_abbr_lower, city_subdomain_lower)
+            ).fetchone()
+        else:
+            # Convert any hyphens in city_subdomain to spaces
+            city_search = city_subdomain_lower.replace('-', ' ')
+            row = conn.execute(
+                "SELECT city_name, main_zip_code FROM Cities WHERE LOWER(city_name) = ? AND LOWER(state_code) = ? ORDER BY id LIMIT 1",
+                (city_search, state_abbr_lower)
+            ).fetchone()
 
     if row:
         return {
@@ -430,21 +2436,8 @@ def get_current_month_year():
 def inject_date():
     return get_current_month_year()
 
-def get_other_cities_in_state(state_abbr, current_city_name):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT city_name
-          FROM Cities
-         WHERE LOWER(state_code) = ?
-           AND LOWER(city_name) != ?
-         ORDER BY city_name ASC
-        """,
-        (state_abbr.lower(), current_city_name.lower())
-    )
-    cities = [row['city_name'] for row in cursor.fetchall()]
-    conn.close()
-    return cities
+# The duplicate DB-backed get_other_cities_in_state function has been removed.
+# The version above, served from the cached city list, is now used for all calls.
 
 @app.route('/')
 def handle_home():
@@ -463,18 +2456,19 @@ def handle_home():
         
         # Get HTML content from domain folder
         home_path = f"domains/{main_domain}/home.html"
+        track_dependency(f"file:{home_path}", "db:states")
         
         try:
             # First try to load the HTML file
             content = load_html_file(home_path)
             if content:
                 # Render the template with Jinja2
-                template = Template(content)
+                template = get_page_template(home_path, content)
                 rendered = template.render(
                     state_links=state_links,
                     required=required_data,
                     canonical_url=get_canonical_url(),
-                    main_service=required_data.get("main-service"),
+                    main_service=primary_service(required_data, None),
                     company_name=required_data.get("company_name")
                 )
                 return rendered
@@ -485,7 +2479,7 @@ def handle_home():
                     state_links=state_links,
                     required=required_data,
                     canonical_url=get_canonical_url(),
-                    main_service=required_data.get("main-service"),
+                    main_service=primary_service(required_data, None),
                     company_name=required_data.get("company_name")
                 )
         except Exception as e:
@@ -496,7 +2490,7 @@ def handle_home():
                 state_links=state_links,
                 required=required_data,
                 canonical_url=get_canonical_url(),
-                main_service=required_data.get("main-service"),
+                main_service=primary_service(required_data, None),
                 company_name=required_data.get("company_name")
             )
     else:
@@ -515,27 +2509,24 @@ def handle_home():
             # Force reload cities from database to bypass cache
             if not cities:
                 print("DEBUG: No cities found in cache, trying direct database query")
-                with sqlite3.connect('newcities.db') as conn:
-                    conn.row_factory = sqlite3.Row
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT city_name FROM Cities WHERE state_code = ?", (state.upper(),))
-                    cities = [row['city_name'] for row in cursor.fetchall()]
-                    print(f"DEBUG: Direct DB query found {len(cities)} cities for {state}: {cities[:5]}...")
+                cities = query_cities_in_state(state)
+                print(f"DEBUG: Direct DB query found {len(cities)} cities for {state}: {cities[:5]}...")
             
             # Load required.json for main service
             required_data = request.required_data
-            main_service = required_data.get("main-service", "")
+            main_service = primary_service(required_data, "")
             
-            # Prepare city links - each city gets its own page
-            city_links = {}
-            for city in cities:
-                # Format city name for URL (lowercase, hyphens instead of spaces)
-                city_slug = city.lower().replace(' ', '-')
-                # Use the subdomain format: main-service-city-state
-                if main_service:
-                    main_service_slug = main_service.lower().replace(' ', '-')
-                    url = f"https://{main_service_slug}-{city_slug}-{state}.{main_domain}"
-                    city_links[city] = url
+            # Prepare city links - each city gets its own page for every service
+            service_city_links = {}
+            for service in domain_services(required_data):
+                links = service_city_links[service] = {}
+                for city in cities:
+                    # Format city name for URL (lowercase, hyphens instead of spaces)
+                    city_slug = city.lower().replace(' ', '-')
+                    # Use the subdomain format: service-city-state
+                    links[city] = f"https://{service_slug(service)}-{city_slug}-{state}.{main_domain}"
+            # city_links stays the primary service's links for existing templates
+            city_links = service_city_links.get(main_service, {})
                     
             # Make sure we have city links
             if not city_links:
@@ -549,13 +2540,14 @@ def handle_home():
             
             # Get HTML content from domain folder
             state_path = f"domains/{main_domain}/state.html"
+            track_dependency(f"file:{state_path}", f"state:{state}")
             
             try:
                 # First try to load the HTML file
                 content = load_html_file(state_path)
                 if content:
                     # First render the template with Jinja2
-                    template = Template(content)
+                    template = get_page_template(state_path, content)
                     print(f"DEBUG: city_links contains {len(city_links)} items")
                     print(f"DEBUG: First 3 city_links: {list(city_links.items())[:3]}")
                     rendered = template.render(
@@ -563,6 +2555,7 @@ def handle_home():
                         state_name=state_full_name,
                         state_full_name=state_full_name,
                         city_links=city_links,
+                        service_city_links=service_city_links,
                         required=required_data,
                         canonical_url=get_canonical_url(),
                         main_service=main_service,
@@ -592,6 +2585,7 @@ def handle_home():
                         state_name=state_full_name,
                         state_full_name=state_full_name,
                         city_links=city_links,
+                        service_city_links=service_city_links,
                         required=required_data,
                         canonical_url=get_canonical_url(),
                         main_service=main_service,
@@ -621,6 +2615,7 @@ def handle_home():
                     state_name=state_full_name,
                     state_full_name=state_full_name,
                     city_links=city_links,
+                    service_city_links=service_city_links,
                     required=required_data,
                     canonical_url=get_canonical_url(),
                     main_service=main_service,
@@ -657,10 +2652,16 @@ def handle_home():
             if not city_info or not state_exists(state_subdomain):
                 abort(404)
                 
-            # Load city.html for the main page
-            city_path = f"domains/{main_domain}/city.html"
+            # Load city.html for the main page, the service's own version if it has one
+            city_path = service_page_path(main_domain, main_service, "city.html")
             
             city_name = city_info['city_name'].title()
+            track_dependency(
+                f"file:{city_path}",
+                f"city:{state_subdomain.lower()}:{city_subdomain.lower()}",
+                f"state:{state_subdomain.lower()}",
+                f"zips:{city_name.lower()}"
+            )
             city_zip_code = city_info['zip_code']
             state_name = get_state_full_name(state_subdomain)
             state_abbreviation = state_subdomain.upper()
@@ -668,11 +2669,23 @@ def handle_home():
             
             # Load required.json for main service
             required_data = request.required_data
-            main_service_name = required_data.get('main-service', main_service)
+            main_service_name = service_name_for(required_data, main_service)
             
             try:
                 content = load_html_file(city_path)
                 if content:
+                    # Render from the cached per-domain fragments when the page allows it
+                    fragments = get_page_fragments(city_path, content, main_service_name, required_data)
+                    if fragments is not None:
+                        rendered = respond_with_fragments(
+                            fragments,
+                            placeholder_values(main_service_name, city_name, state_abbreviation, state_name,
+                                               required_data, zip_codes, city_zip_code),
+                            f"{city_name}|{state_abbreviation}"
+                        )
+                        if rendered is not None:
+                            return rendered
+
                     # Get other cities in the same state for navigation
                     other_cities = get_other_cities_in_state(state_subdomain, city_name)
                     other_city_links = {}
@@ -752,17 +2765,36 @@ def handle_page(page_name):
     
     # Load required.json for main service
     required_data = request.required_data
-    main_service_name = required_data.get('main-service', main_service)
+    main_service_name = service_name_for(required_data, main_service)
     
     # Get HTML content from domain folder - could be a service page or other page like about.html
     main_domain = get_main_domain()
-    page_path = f"domains/{main_domain}/{page_name}.html"
+    page_path = service_page_path(main_domain, main_service, f"{page_name}.html")
+    track_dependency(
+        f"file:{page_path}",
+        f"city:{state_subdomain.lower()}:{city_subdomain.lower()}",
+        f"state:{state_subdomain.lower()}",
+        f"zips:{city_name.lower()}"
+    )
     
     try:
         content = load_html_file(page_path)
         if not content:
             abort(404)
             
+        # Render from the cached per-domain fragments when the page allows it
+        fragments = get_page_fragments(page_path, content, main_service_name, required_data)
+        if fragments is not None:
+            rendered = respond_with_fragments(
+                fragments,
+                placeholder_values(main_service_name, city_name, state_abbreviation, state_name,
+                                   required_data, zip_codes, city_zip_code),
+                f"{city_name}|{state_abbreviation}",
+                canonical_url=get_canonical_url(f"/{page_name}")
+            )
+            if rendered is not None:
+                return rendered
+
         # Replace placeholders in the HTML content
         processed_content = replace_placeholders(
             content,
@@ -798,7 +2830,7 @@ def handle_page(page_name):
                     
                     # Load required.json for main service
                     required_data = request.required_data
-                    main_service_name = required_data.get('main-service', main_service)
+                    main_service_name = service_name_for(required_data, main_service)
                     
                     # Create a Jinja2 template from the processed content
                     template = Template(processed_content)
@@ -820,6 +2852,50 @@ def handle_page(page_name):
         print(f"Error serving page {page_name}: {e}")
         abort(404)
 
+# Largest number of matches /api/cities returns
+CITY_SEARCH_MAX_LIMIT = 50
+
+@app.route('/api/cities')
+def api_cities():
+    """City autocomplete: /api/cities?q=spr&state=tx&limit=10
+
+    Returns the matching cities with their page URLs, built like the city links
+    of the state pages: "url" for the primary service and "services" for every
+    service of the domain. Served from db_cache.city_search, never from the database.
+    """
+    query = request.args.get('q', '').lstrip()
+    state = request.args.get('state', '').strip().lower() or None
+    limit = max(1, min(request.args.get('limit', 10, type=int) or 10, CITY_SEARCH_MAX_LIMIT))
+    if state is not None and state not in db_cache.states:
+        return jsonify({"error": f"Unknown state: {state}"}), 404
+
+    main_domain = get_main_domain()
+    services = domain_services(request.required_data)
+    if not services:
+        return jsonify({"error": f"No 'main-service' defined for {main_domain}"}), 404
+
+    cities = []
+    for abbr, city in db_cache.city_search.search(query, state, limit):
+        city_slug = city.lower().replace(' ', '-')
+        urls = [
+            {"service": service, "url": f"https://{service_slug(service)}-{city_slug}-{abbr}.{main_domain}"}
+            for service in services
+        ]
+        cities.append({
+            "city": city,
+            "state": abbr.upper(),
+            "url": urls[0]["url"],
+            "services": urls
+        })
+
+    response = jsonify({"query": query, "state": state, "cities": cities})
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    return response.make_conditional(request)
+
+# Labels of letters, digits and hyphens separated by single dots: no '/', '..' or dot directories
+DOMAIN_NAME_PATTERN = re.compile(r'^[A-Za-z0-9-]+(\.[A-Za-z0-9-]+)+$')
+
 @app.route('/update-files', methods=['PUT'])
 def update_files():
     """Update multiple files for a specific domain and reload only that domain's cache
@@ -887,6 +2963,10 @@ def update_files():
         # Remove port if present
         if ':' in domain:
             domain = domain.split(':', 1)[0]
+
+        # The domain becomes a directory name, accept host names only
+        if not DOMAIN_NAME_PATTERN.match(domain):
+            return jsonify({"error": f"Invalid domain: {domain}"}), 400
             
         # Create domain directory if it doesn't exist
         domain_dir = f"domains/{domain}"
@@ -895,7 +2975,17 @@ def update_files():
         # Print the received files for debugging
         print(f"Processing {len(files)} files for domain {domain}")
         
+        # Reject broken templates before anything is written
+        for file_item in files:
+            if isinstance(file_item, dict) and isinstance(file_item.get('filename'), str) and \
+                    file_item['filename'].endswith('.html') and isinstance(file_item.get('content'), str):
+                error = validate_page_source(os.path.join(domain_dir, file_item['filename']), file_item['content'])
+                if error:
+                    return jsonify({"error": error}), 400
+
         updated_files = []
+        minified_files = {}
+        changed_sources = set()
         for i, file_item in enumerate(files):
             # Validate each file item
             if not isinstance(file_item, dict):
@@ -911,7 +3001,7 @@ def update_files():
             content = file_item['content']
             
             # Prevent directory traversal attacks
-            if '..' in filename or filename.startswith('/'):
+            if '..' in filename or filename.startswith('/') or COMPILED_DIR in filename.split('/'):
                 return jsonify({"error": f"Invalid filename: {filename}"}), 400
                 
             file_path = os.path.join(domain_dir, filename)
@@ -924,62 +3014,178 @@ def update_files():
                 try:
                     # Validate JSON content
                     json_content = json.loads(content) if isinstance(content, str) else content
-                    with open(file_path, 'w', encoding='utf-8') as f:
-                        json.dump(json_content, f, indent=4)
                 except json.JSONDecodeError:
                     return jsonify({"error": f"Invalid JSON content for {filename}"}), 400
+
+                # Compare with the previous version so only pages using changed fields are invalidated
+                try:
+                    with open(file_path, 'r', encoding='utf-8') as f:
+                        old_content = json.load(f)
+                except (OSError, ValueError):
+                    old_content = None
+                changed_fields = changed_json_fields(old_content, json_content)
+                if changed_fields:
+                    # Pages that iterate over the whole object depend on every field
+                    changed_fields.add('*')
+                changed_sources.update(f"field:{file_path}#{key}" for key in changed_fields)
+
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    json.dump(json_content, f, indent=4)
             else:
                 # Write as plain text
                 with open(file_path, 'w', encoding='utf-8') as f:
                     f.write(content)
                     
             updated_files.append(filename)
+            changed_sources.add(f"file:{file_path}")
             
-            # Invalidate specific file cache
-            if filename.endswith('.json'):
-                cache.delete_memoized(load_json, file_path)
-            elif filename.endswith('.html'):
-                cache.delete_memoized(load_html_file, file_path)
-        
-        # Invalidate domain-specific caches
-        # Since we can't directly access cache keys in Flask-Caching,
-        # we'll invalidate specific known caches related to the domain
-        
-        # Invalidate HTML file cache for this domain
-        for filename in updated_files:
+            # JSON files are re-read on their next load because their stamp changed
             if filename.endswith('.html'):
-                file_path = os.path.join(domain_dir, filename)
-                print(f"Invalidating cache for HTML file: {file_path}")
-                cache.delete_memoized(load_html_file, file_path)
+                print(f"Reloading cache for HTML file: {file_path}")
+                stored = html_store.put(file_path, content, stamp=file_stamp(file_path))
+                compile_page_artifacts(file_path, content, stored)
+                if app.config['MINIFY_HTML']:
+                    minified_files[filename] = {
+                        "original_bytes": len(content.encode('utf-8')),
+                        "minified_bytes": len(stored.encode('utf-8'))
+                    }
         
-        # Invalidate JSON file cache for this domain
-        for filename in updated_files:
-            if filename.endswith('.json'):
-                file_path = os.path.join(domain_dir, filename)
-                print(f"Invalidating cache for JSON file: {file_path}")
-                cache.delete_memoized(load_json, file_path)
-                
-        # If required.json was updated, invalidate domain data cache
-        if any(f == "required.json" for f in updated_files):
-            print(f"Invalidating domain data cache for {domain}")
-            cache.delete_memoized(get_domain_data, domain)
-            
-        # Clear city and state caches if needed
-        # This is a more aggressive approach but ensures data consistency
-        if any(f.endswith('.json') for f in updated_files):
-            print("Invalidating city and state caches")
-            cache.delete_memoized(get_cities_in_state)
-            cache.delete_memoized(get_states)
+        # Invalidate exactly the rendered pages built from the updated files and fields
+        invalidated_pages = invalidate_dependents(changed_sources)
+        print(f"Invalidated {invalidated_pages} rendered pages for {domain}")
         
         return jsonify({
             "success": True, 
             "message": f"Updated {len(updated_files)} files for {domain}",
-            "updated_files": updated_files
+            "updated_files": updated_files,
+            "invalidated_pages": invalidated_pages,
+            "minified": minified_files
         })
     except Exception as e:
         print(f"Error in update_files: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/admin/reload-db', methods=['GET', 'POST'])
+def admin_reload_db():
+    """Reload newcities.db now (POST) or show the last reload statistics (GET)"""
+    require_admin_token()
+    if request.method == 'POST':
+        stats = reload_database(force=request.args.get('force') == '1')
+        if stats is None:
+            return jsonify({"reloaded": False, "version": db_cache.version})
+        return jsonify(dict(stats, reloaded=True))
+    return jsonify({"version": db_cache.version, "last_reload": last_db_reload})
+
+@app.route('/admin/cache-partitions')
+def admin_cache_partitions():
+    """Per-domain occupancy and hit rates of the page and fragment caches"""
+    require_admin_token()
+    return jsonify({"pages": page_cache.stats(), "fragments": page_fragments.stats()})
+
+@app.route('/admin/admission')
+def admin_admission():
+    """Cold renders admitted and rejected by admission control since the worker started"""
+    require_admin_token()
+    with admission_stats_lock:
+        stats = dict(admission_stats)
+    return jsonify(dict(stats, enabled=app.config['ADMISSION_ENABLED']))
+
+@app.route('/admin/content-store')
+def admin_content_store():
+    """Dedup statistics of the content-addressed page store"""
+    require_admin_token()
+    return jsonify(html_store.stats())
+
+# Memoized functions whose SimpleCache entries are reported separately
+MEMOIZED_FUNCTIONS = ('_load_json', 'get_cities_in_state', 'get_state_full_name', 'state_exists')
+
+def size_report(items, top=10):
+    """Entry count, deep size and the top largest keys of an iterable of (key, value) pairs"""
+    sizes = [(deep_sizeof(key) + deep_sizeof(value), key) for key, value in items]
+    sizes.sort(key=lambda item: item[0], reverse=True)
+    return {
+        'entries': len(sizes),
+        'bytes': sum(size for size, _ in sizes),
+        'top_keys': [{'key': str(key), 'bytes': size} for size, key in sizes[:top]],
+    }
+
+def simple_cache_items():
+    """Group SimpleCache entries by memoized function and other keys.
+
+    flask_caching memoize keys are hashes suffixed with the function's version
+    string, which is stored under '<module>.<function>_memver'.
+    """
+    entries = dict(getattr(cache.cache, '_cache', {}))
+    versions = {}
+    for name in MEMOIZED_FUNCTIONS:
+        function = globals()[name]
+        version_key = f"{function.__module__}.{function.__qualname__}_memver"
+        version = cache.get(version_key)
+        if version:
+            versions[version] = name
+    groups = {name: [] for name in MEMOIZED_FUNCTIONS}
+    groups['other'] = []
+    for key, value in entries.items():
+        name = next((name for version, name in versions.items() if key.endswith(version) and key != version), None)
+        groups[name or 'other'].append((key, value))
+    return groups
+
+def memory_report(top=10):
+    """Per-worker memory footprint of the database cache and every in-process cache"""
+    current_cache = db_cache
+    report = {
+        'pid': os.getpid(),
+        'rss_kb': current_rss_kb(),
+        'database': {
+            name: size_report(getattr(current_cache, name).items(), top)
+            for name in ('states', 'cities', 'zip_codes', 'city_index', 'spintax_seeds', 'city_search')
+        },
+        'simple_cache': {
+            name: size_report(items, top) for name, items in simple_cache_items().items()
+        },
+        'html_store': size_report(((path, (text, artifacts)) for path, text, artifacts in html_store.items()), top),
+        'spintax_templates': size_report(spintax_templates.items(), top),
+        'spintax_choices': size_report(spintax_choices.items(), top),
+        'page_cache': size_report(page_cache.items(), top),
+        'page_fragments': size_report(page_fragments.items(), top),
+    }
+    sections = [report['database'], report['simple_cache']]
+    report['total_bytes'] = sum(part['bytes'] for section in sections for part in section.values()) + \
+        sum(report[name]['bytes'] for name in ('html_store', 'spintax_templates', 'spintax_choices',
+                                               'page_cache', 'page_fragments'))
+    return report
+
+@app.route('/admin/memory')
+def admin_memory():
+    """Memory footprint of this worker's caches (?top=N largest keys per structure)"""
+    require_admin_token()
+    return jsonify(memory_report(request.args.get('top', 10, type=int)))
+
+@app.cli.command('memory-report')
+@click.option('--top', default=10, help='Largest keys listed per structure.')
+@click.option('--workers', default=1, help='Worker count used for the RSS estimate.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the full report as JSON.')
+def memory_report_command(top, workers, as_json):
+    """Report the memory held by the database cache and every cache of this process.
+
+    A fresh process only holds the database cache; query /admin/memory on a
+    running worker to include its warmed request caches.
+    """
+    report = memory_report(top)
+    if as_json:
+        print(json.dumps(report, indent=1))
+        return
+    for section in ('database', 'simple_cache'):
+        for name, part in report[section].items():
+            print(f"{section}.{name}: {part['entries']} entries, {part['bytes'] / 1024:.1f} KiB")
+            for item in part['top_keys'][:3]:
+                print(f"    {item['key'][:60]}: {item['bytes'] / 1024:.1f} KiB")
+    for name in ('html_store', 'spintax_templates', 'spintax_choices', 'page_cache', 'page_fragments'):
+        part = report[name]
+        print(f"{name}: {part['entries']} entries, {part['bytes'] / 1024:.1f} KiB")
+    print(f"accounted: {report['total_bytes'] / 1024:.1f} KiB, RSS: {report['rss_kb']} KiB, "
+          f"estimated RSS for {workers} workers: {report['rss_kb'] * workers / 1024:.1f} MiB")
+
 @app.errorhandler(404)
 def page_not_found(e):
     """Handle 404 errors"""
@@ -1004,7 +3210,7 @@ def page_not_found(e):
                 
                 # Load required.json for main service
                 required_data = request.required_data
-                main_service_name = required_data.get('main-service', main_service)
+                main_service_name = service_name_for(required_data, main_service)
                 
                 # Try to load and process the 404 page with placeholders
                 content = load_html_file(custom_404_path)
@@ -1036,6 +3242,8 @@ def page_not_found(e):
 
 @app.route('/domains/<domain>/<path:filename>')
 def serve_domain_static(domain, filename):
+    if COMPILED_DIR in filename.split('/'):
+        abort(404)
     domain_dir = os.path.join('domains', domain)
     return send_from_directory(domain_dir, filename)
 
@@ -1051,5 +3259,176 @@ def serve_static(filename):
     
     return send_from_directory(static_folder, filename)
 
+@app.cli.command('compile-pages')
+@click.option('--domain', default=None, help='Only compile this domain.')
+def compile_pages_command(domain):
+    """Validate every page and write its compiled artifacts, like /update-files does."""
+    domains = [domain] if domain else sorted(os.listdir('domains')) if os.path.isdir('domains') else []
+    failed = 0
+    for name in domains:
+        compiled = 0
+        for root, dirs, files in os.walk(os.path.join('domains', name)):
+            dirs[:] = [d for d in dirs if d != COMPILED_DIR]
+            for filename in sorted(files):
+                if not filename.endswith('.html'):
+                    continue
+                page_path = os.path.join(root, filename)
+                with open(page_path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                error = validate_page_source(page_path, text)
+                if error:
+                    print(f"  {page_path}: {error}")
+                    failed += 1
+                    continue
+                compile_page_artifacts(page_path, text, prepare_page_source(text))
+                compiled += 1
+        print(f"{name}: {compiled} pages compiled")
+    if failed:
+        raise SystemExit(1)
+
+@app.cli.command('minify-report')
+@click.option('--domain', default=None, help='Only report this domain.')
+def minify_report_command(domain):
+    """Report the byte reduction of minifying every domain's pages."""
+    domains = [domain] if domain else sorted(os.listdir('domains')) if os.path.isdir('domains') else []
+    for name in domains:
+        original_total = minified_total = 0
+        for root, _, files in os.walk(os.path.join('domains', name)):
+            for filename in sorted(files):
+                if not filename.endswith('.html'):
+                    continue
+                with open(os.path.join(root, filename), 'r', encoding='utf-8') as f:
+                    original = f.read()
+                minified = minify_html(original)
+                if not minified_equivalent(original, minified):
+                    print(f"  {os.path.join(root, filename)}: differs beyond whitespace, left unminified")
+                    minified = original
+                original_total += len(original.encode('utf-8'))
+                minified_total += len(minified.encode('utf-8'))
+        saved = original_total - minified_total
+        percent = saved / original_total * 100 if original_total else 0.0
+        print(f"{name}: {original_total} -> {minified_total} bytes ({saved} saved, {percent:.1f}%)")
+
+def sign_profile_request(secret, host, path, ttl=300):
+    """Return an X-Profile-Signature value allowing one URL to be profiled for ttl seconds"""
+    expires = int(time.time()) + ttl
+    message = f"{expires}:{host.lower()}{path}".encode('utf-8')
+    return f"{expires}.{hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()}"
+
+class CollapsedStackProfiler:
+    """Deterministic profiler producing flamegraph-compatible collapsed stacks.
+
+    Installed with sys.setprofile on the request thread only. Each line of the
+    output is 'frame;frame;frame <self time in microseconds>'.
+    """
+    def __init__(self):
+        self.samples = {}
+        self._stack = []
+
+    @staticmethod
+    def _label(frame, event, arg):
+        if event.startswith('c_'):
+            module = getattr(arg, '__module__', None) or 'builtins'
+            return f"{module}.{getattr(arg, '__qualname__', getattr(arg, '__name__', repr(arg)))}"
+        return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}"
+
+    def _callback(self, frame, event, arg):
+        now = time.perf_counter()
+        if event in ('call', 'c_call'):
+            self._stack.append([self._label(frame, event, arg), now, 0.0])
+        elif self._stack:
+            label, started, child_time = self._stack.pop()
+            elapsed = now - started
+            key = ';'.join(entry[0] for entry in self._stack) + (';' if self._stack else '') + label
+            self.samples[key] = self.samples.get(key, 0.0) + (elapsed - child_time)
+            if self._stack:
+                self._stack[-1][2] += elapsed
+
+    def __enter__(self):
+        sys.setprofile(self._callback)
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.setprofile(None)
+
+    def collapsed(self):
+        return ''.join(f"{stack} {max(1, int(seconds * 1e6))}\n"
+                       for stack, seconds in sorted(self.samples.items()))
+
+class ProfilingMiddleware:
+    """Profile single requests that carry a valid X-Profile-Signature header.
+
+    The artifact is written to PROFILE_DIR and named in the X-Profile-Artifact
+    response header; with 'X-Profile-Output: inline' the collapsed stacks are
+    returned instead of the page.
+    """
+    def __init__(self, wsgi_app, secret, output_dir):
+        self.wsgi_app = wsgi_app
+        self.secret = secret
+        self.output_dir = output_dir
+
+    def _verify(self, environ):
+        signature = environ.get('HTTP_X_PROFILE_SIGNATURE', '')
+        expires, _, digest = signature.partition('.')
+        if not expires.isdigit() or int(expires) < time.time():
+            return False
+        host = environ.get('HTTP_HOST', '').lower()
+        message = f"{expires}:{host}{environ.get('PATH_INFO', '')}".encode('utf-8')
+        expected = hmac.new(self.secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(digest, expected)
+
+    def __call__(self, environ, start_response):
+        if 'HTTP_X_PROFILE_SIGNATURE' not in environ or not self._verify(environ):
+            return self.wsgi_app(environ, start_response)
+
+        environ['app.profiling'] = True
+        captured = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured['status'] = status
+            captured['headers'] = headers
+            return lambda data: None
+
+        with CollapsedStackProfiler() as profiler:
+            app_iter = self.wsgi_app(environ, capture_start_response)
+            try:
+                body = b''.join(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+        collapsed = profiler.collapsed()
+
+        path = environ.get('PATH_INFO', '/').strip('/').replace('/', '_') or 'index'
+        name = f"{int(time.time() * 1000)}-{environ.get('HTTP_HOST', 'unknown').lower()}-{path}.collapsed"
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, name), 'w', encoding='utf-8') as f:
+            f.write(collapsed)
+        print(f"Stored request profile {name}")
+
+        if environ.get('HTTP_X_PROFILE_OUTPUT') == 'inline':
+            body = collapsed.encode('utf-8')
+            headers = [('Content-Type', 'text/plain; charset=utf-8')]
+            status = '200 OK'
+        else:
+            headers = [(key, value) for key, value in captured['headers'] if key.lower() != 'content-length']
+            status = captured['status']
+        headers.append(('Content-Length', str(len(body))))
+        headers.append(('X-Profile-Artifact', name))
+        start_response(status, headers)
+        return [body]
+
+if app.config['PROFILE_SECRET']:
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app, app.config['PROFILE_SECRET'], app.config['PROFILE_DIR'])
+
+@app.cli.command('profile-signature')
+@click.argument('host')
+@click.argument('path', default='/')
+@click.option('--ttl', default=300, help='Seconds the signature stays valid.')
+def profile_signature_command(host, path, ttl):
+    """Print an X-Profile-Signature header value for HOST and PATH."""
+    if not app.config['PROFILE_SECRET']:
+        raise click.ClickException('PROFILE_SECRET is not set')
+    print(f"X-Profile-Signature: {sign_profile_request(app.config['PROFILE_SECRET'], host, path, ttl)}")
+
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8001)
\ No newline at end of file
@@ -0,0 +1,75 @@
+"""Benchmark /api/cities lookups over the full city set.
+
+Builds every 1 to --max-prefix character prefix of every city name in
+db_cache, and times:
+
+    index     db_cache.city_search.search() for each prefix, with and without a state
+    scan      a linear scan over all names (what a search without an index costs)
+    endpoint  full /api/cities requests through the Flask test client (a sample)
+
+Usage:
+    python bench_autocomplete.py --domain demo.com --max-prefix 4 --sample 2000
+"""
+import argparse
+import random
+import time
+
+import app as app_module
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda pct: samples[min(len(samples) - 1, int(pct / 100.0 * len(samples)))]
+    return f"p50={pick(50) * 1e6:8.2f}us  p99={pick(99) * 1e6:8.2f}us  max={samples[-1] * 1e6:8.2f}us"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--domain', required=True)
+    parser.add_argument('--max-prefix', type=int, default=4)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--sample', type=int, default=2000, help='queries used for the scan and endpoint timings')
+    args = parser.parse_args()
+
+    cities = [(abbr, city) for abbr, names in app_module.db_cache.cities.items() for city in names]
+    queries = sorted({
+        (city.lower()[:length], abbr)
+        for abbr, city in cities for length in range(1, args.max_prefix + 1)
+    })
+    print(f"{len(cities)} cities, {len(queries)} distinct (prefix, state) queries")
+
+    started = time.perf_counter()
+    index = app_module.CitySearchIndex(app_module.db_cache.cities)
+    print(f"index build: {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    for label, with_state in (('index, all states', False), ('index, one state', True)):
+        timings = []
+        for prefix, abbr in queries:
+            started = time.perf_counter()
+            index.search(prefix, abbr if with_state else None, args.limit)
+            timings.append(time.perf_counter() - started)
+        print(f"{label:18} {percentiles(timings)}")
+
+    sample = random.Random(1).sample(queries, min(args.sample, len(queries)))
+    names = [(city.lower(), abbr, city) for abbr, city in cities]
+    timings = []
+    for prefix, _ in sample:
+        started = time.perf_counter()
+        sorted(entry for entry in names if entry[0].startswith(prefix))[:args.limit]
+        timings.append(time.perf_counter() - started)
+    print(f"{'scan, all states':18} {percentiles(timings)}")
+
+    client = app_module.app.test_client()
+    timings = []
+    for prefix, abbr in sample:
+        started = time.perf_counter()
+        response = client.get('/api/cities', query_string={'q': prefix, 'state': abbr, 'limit': args.limit},
+                              base_url=f"https://{args.domain}")
+        timings.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            raise SystemExit(f"/api/cities?q={prefix}&state={abbr} returned {response.status_code}")
+    print(f"{'endpoint':18} {percentiles(timings)}")
+
+
+if __name__ == '__main__':
+    main()
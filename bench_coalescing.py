@@ -0,0 +1,86 @@
+"""Measure the CPU saved by coalescing a burst of identical cold page requests.
+
+Fires --burst concurrent requests for the same cold page (the page cache is
+cleared before every burst) from threads inside one process, once with
+COALESCE_RENDERS off and once with it on, and reports how many requests
+rendered the page (X-Cache: MISS), how many received a coalesced response, and
+the process CPU time and wall time of each burst.
+
+Usage:
+    python bench_coalescing.py --domain demo.com --page big-service --burst 32 --rounds 5
+"""
+import argparse
+import threading
+import time
+from collections import Counter
+
+import app as app_module
+
+
+def burst(host, path, size):
+    """Send size identical requests at once; return (X-Cache counter, cpu seconds, wall seconds)"""
+    app_module.page_cache.clear()
+    barrier = threading.Barrier(size + 1)
+    outcomes = Counter()
+    lock = threading.Lock()
+
+    def worker():
+        client = app_module.app.test_client()
+        barrier.wait()
+        response = client.get(path, base_url=f"https://{host}")
+        with lock:
+            outcomes[(response.status_code, response.headers.get('X-Cache'))] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(size)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return outcomes, time.process_time() - cpu_started, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--domain', required=True)
+    parser.add_argument('--page', default='', help='page name under domains/<domain>/ (default: the city home)')
+    parser.add_argument('--burst', type=int, default=32)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    required_data = app_module.load_json(f"domains/{args.domain}/required.json")
+    service_slug = app_module.service_slug(app_module.primary_service(required_data))
+    abbr, names = next(iter(sorted(app_module.db_cache.cities.items())))
+    host = f"{service_slug}-{app_module.city_slug(names[0])}-{abbr}.{args.domain}"
+    path = f"/{args.page}"
+
+    # Admission control would turn part of the burst away, measure rendering only
+    app_module.app.config['ADMISSION_ENABLED'] = False
+    # Compile the page source and fragments once, so bursts only measure rendering
+    app_module.app.test_client().get(path, base_url=f"https://{host}")
+    print(f"{args.burst} concurrent requests for https://{host}{path}, {args.rounds} rounds")
+    cpu_by_mode = {}
+    for coalesce in (False, True):
+        app_module.app.config['COALESCE_RENDERS'] = coalesce
+        totals = Counter()
+        cpu = wall = 0.0
+        for _ in range(args.rounds):
+            outcomes, burst_cpu, burst_wall = burst(host, path, args.burst)
+            totals.update(outcomes)
+            cpu += burst_cpu
+            wall += burst_wall
+        mode = 'coalesced' if coalesce else 'independent'
+        cpu_by_mode[mode] = cpu
+        summary = ', '.join(f"{status} {cache_state}: {count}" for (status, cache_state), count in sorted(totals.items()))
+        print(f"{mode:12} cpu/burst={cpu / args.rounds * 1000:8.1f}ms  wall/burst={wall / args.rounds * 1000:8.1f}ms  [{summary}]")
+
+    if cpu_by_mode['coalesced']:
+        print(f"CPU saved: {(1 - cpu_by_mode['coalesced'] / cpu_by_mode['independent']) * 100:.1f}% "
+              f"({cpu_by_mode['independent'] / cpu_by_mode['coalesced']:.1f}x less CPU per burst)")
+    print(f"coalescing stats: {app_module.coalesce_stats}")
+
+
+if __name__ == '__main__':
+    main()
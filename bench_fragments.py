@@ -0,0 +1,116 @@
+"""Measure per-request work of fragment rendering against the full pipeline.
+
+For a page of a domain, renders it for a sample of cities through
+replace_placeholders (the full pipeline) and through the cached per-domain
+fragments, and reports the bytes each path processes per request and the
+render time.
+
+Bytes processed by the full pipeline are the lengths of every string each
+pass scans or builds (two protection regexes, the spintax pass, one str.replace
+per placeholder and one per restored block). The fragment path only builds the
+city-level slot values and copies segments once into the joined response.
+
+Usage:
+    python bench_fragments.py --domain demo.com --page city --cities 500
+"""
+import argparse
+import time
+
+import app as app_module
+
+
+def full_pipeline_bytes(text, values, city_state_key):
+    """Replay replace_placeholders and count the bytes each pass touches"""
+    processed = 0
+    processed += len(text)
+    marked, fully_protected_blocks, schema_blocks = app_module.protect_blocks(text)
+    processed += len(marked)  # second protection pass scans the partially marked text
+    processed += len(marked)
+    text = app_module.resolve_spintax(marked, city_state_key)
+    processed += len(text)
+    for placeholder, value in values.items():
+        text = text.replace(placeholder, str(value))
+        processed += len(text)
+    for i, block in enumerate(fully_protected_blocks):
+        text = text.replace(f"__FULLY_PROTECTED_BLOCK_{i}__", block)
+        processed += len(text)
+    for i, (opening, content, closing) in enumerate(schema_blocks):
+        for placeholder, value in values.items():
+            content = content.replace(placeholder, str(value))
+            processed += len(content)
+        text = text.replace(f"__SCHEMA_BLOCK_{i}__", opening + content + closing)
+        processed += len(text)
+    return processed, len(text)
+
+
+def fragment_bytes(fragments, values, output_length):
+    """Bytes built per request by render_page_fragments: slot values plus the final join"""
+    slot_bytes = sum(len(str(values[name]).encode('utf-8')) for name in fragments.city_placeholders)
+    return slot_bytes + output_length
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--domain', required=True)
+    parser.add_argument('--page', default='city', help='page name under domains/<domain>/ (without .html)')
+    parser.add_argument('--cities', type=int, default=500)
+    args = parser.parse_args()
+
+    page_path = f"domains/{args.domain}/{args.page}.html"
+    source = app_module.load_html_file(page_path)
+    if not source:
+        raise SystemExit(f"{page_path} not found")
+    required_data = app_module.load_json(f"domains/{args.domain}/required.json")
+    service_name = app_module.primary_service(required_data)
+    service_slug = app_module.service_slug(service_name)
+
+    cities = [(city, abbr) for abbr, names in sorted(app_module.db_cache.cities.items()) for city in names]
+    cities = cities[:args.cities]
+
+    full_bytes = frag_bytes = 0
+    full_time = frag_time = 0.0
+    rendered = fallbacks = 0
+    for city, abbr in cities:
+        city_name = city.title()
+        state_abbreviation = abbr.upper()
+        host = f"{service_slug}-{app_module.city_slug(city)}-{abbr}.{args.domain}"
+        with app_module.app.test_request_context('/', base_url=f"https://{host}"):
+            values = app_module.placeholder_values(
+                service_name, city_name, state_abbreviation, app_module.db_cache.states.get(abbr, ''),
+                required_data, app_module.get_zip_codes_from_db(city_name), ''
+            )
+            city_state_key = f"{city_name}|{state_abbreviation}"
+
+            started = time.perf_counter()
+            app_module.replace_placeholders(
+                source, service_name, city_name, state_abbreviation, values['[State Full]'],
+                required_data, app_module.get_zip_codes_from_db(city_name), ''
+            )
+            full_time += time.perf_counter() - started
+            processed, _ = full_pipeline_bytes(source, values, city_state_key)
+            full_bytes += processed
+
+            started = time.perf_counter()
+            fragments = app_module.get_page_fragments(page_path, source, service_name, required_data)
+            output = app_module.render_page_fragments(fragments, values, city_state_key) if fragments else None
+            frag_time += time.perf_counter() - started
+            if output is None:
+                fallbacks += 1
+                continue
+            frag_bytes += fragment_bytes(fragments, values, len(output))
+            rendered += 1
+
+    n = len(cities)
+    print(f"{page_path}: {len(source)} source chars, {n} cities")
+    if rendered:
+        print(f"static bytes per domain (rendered once): {fragments.static_bytes}")
+    print(f"full pipeline : {full_bytes / n:12.0f} bytes processed/request  {full_time / n * 1e6:9.1f} us/request")
+    if rendered:
+        print(f"fragments     : {frag_bytes / rendered:12.0f} bytes processed/request  {frag_time / n * 1e6:9.1f} us/request")
+        print(f"reduction     : {full_bytes / n / (frag_bytes / rendered):.1f}x fewer bytes")
+    if fallbacks:
+        print(f"{fallbacks} renders fell back to the full pipeline")
+
+
+if __name__ == '__main__':
+    main()
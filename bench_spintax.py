@@ -0,0 +1,123 @@
+"""Check that spintax parsing stays linear on large, deeply nested and adversarial input.
+
+For every input family the text is doubled a few times and parse_spintax and
+resolve_spintax are timed on each size; a time ratio close to 2 per doubling
+means linear scaling. The previous parser, a single r'\{([^}]*)\}' regex plus
+splitting the groups on '|', is timed on the same input at every size for
+comparison. It rescans to the end of the text from every unclosed '{', which
+is quadratic, so it runs in a child process and is reported as timed out after
+--legacy-timeout seconds.
+
+Usage:
+    python bench_spintax.py --base 20000 --doublings 4
+"""
+import argparse
+import multiprocessing
+import queue
+import re
+import time
+
+import app as app_module
+
+LEGACY_SPINTAX_PATTERN = re.compile(r'\{([^}]*)\}')
+
+
+def legacy_parse(text):
+    """The literals and option groups the previous compile_spintax built"""
+    literals = []
+    groups = []
+    position = 0
+    for match in LEGACY_SPINTAX_PATTERN.finditer(text):
+        literals.append(text[position:match.start()])
+        groups.append(tuple(match.group(1).split('|')))
+        position = match.end()
+    literals.append(text[position:])
+    return literals, groups
+
+
+def flat(n):
+    """A large page body: text with one {a|b|c} group per sentence"""
+    return ''.join(f"<p>{{Call|Phone|Ring}} us about job {i}, {{fast|quick}} service.</p>\n" for i in range(n // 60 + 1))
+
+
+def nested(n):
+    """One group nested n/6 levels deep"""
+    depth = n // 6 + 1
+    return '{a|' * depth + 'x' + '}' * depth
+
+
+def unclosed(n):
+    """Opening braces that are never closed"""
+    return '{' * n
+
+
+def unclosed_jinja(n):
+    """Jinja openers without closers, each would rescan the rest of the text"""
+    return '{{ x ' * (n // 5 + 1)
+
+
+def mixed(n):
+    """Escapes, Jinja constructs and nested groups together"""
+    unit = r'\{not\|spun\} {{ value }} {% if x %}{a|{b|c}}{% endif %} '
+    return unit * (n // len(unit) + 1)
+
+
+FAMILIES = [flat, nested, unclosed, unclosed_jinja, mixed]
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - started
+
+
+def _timed_legacy_worker(text, results):
+    results.put(timed(legacy_parse, text))
+
+
+def timed_legacy(text, timeout):
+    """Seconds legacy_parse takes on text, or None if it did not finish within timeout"""
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    process = context.Process(target=_timed_legacy_worker, args=(text, results))
+    process.start()
+    try:
+        return results.get(timeout=timeout)
+    except queue.Empty:
+        return None
+    finally:
+        process.terminate()
+        process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base', type=int, default=20000, help='input size in characters of the first round')
+    parser.add_argument('--doublings', type=int, default=4)
+    parser.add_argument('--legacy-timeout', type=float, default=10.0,
+                        help='seconds after which a legacy parse is reported as timed out')
+    args = parser.parse_args()
+
+    key = 'Abilene|TX'
+    for family in FAMILIES:
+        print(f"{family.__name__}: {family.__doc__}")
+        previous = None
+        for step in range(args.doublings + 1):
+            text = family(args.base * 2 ** step)
+            app_module.spintax_templates.clear()
+            app_module.spintax_choices.clear()
+            parse = timed(app_module.parse_spintax, text)
+            resolve = timed(app_module.resolve_spintax, text, key)
+            legacy = timed_legacy(text, args.legacy_timeout)
+            ratio = f"x{parse / previous:4.2f}" if previous else '     '
+            if legacy is None:
+                legacy_text = f"timed out after {args.legacy_timeout:g}s"
+            else:
+                legacy_text = f"{legacy * 1000:9.2f}ms  parse/legacy={parse / legacy if legacy else 0:6.2f}"
+            print(f"  {len(text):>9} chars  parse={parse * 1000:8.2f}ms {ratio}  "
+                  f"compile+resolve={resolve * 1000:8.2f}ms  legacy={legacy_text}")
+            previous = parse
+
+
+if __name__ == '__main__':
+    main()
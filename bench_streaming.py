@@ -0,0 +1,90 @@
+"""Compare time-to-first-byte and peak allocation of streamed and buffered pages.
+
+Requests a service page for a sample of cities through the Flask test client in
+three modes and reports, per request:
+
+    full      the full replace_placeholders pipeline (fragments disabled)
+    buffered  fragment rendering, body joined into one bytes object
+    streamed  fragment rendering, body streamed in STREAM_CHUNK_SIZE chunks
+
+TTFB is the time until the first body chunk is available; peak allocation is
+the tracemalloc peak while the response is produced and consumed (for
+streamed pages it includes the joined body kept for the page cache). The page
+cache is cleared before every request and admission control is disabled, so
+every request is a cold render.
+
+Usage:
+    python bench_streaming.py --domain demo.com --page big-service --cities 50
+"""
+import argparse
+import statistics
+import time
+import tracemalloc
+
+import app as app_module
+
+
+def measure(client, hosts, path):
+    ttfb = []
+    peaks = []
+    for host in hosts:
+        app_module.page_cache.clear()
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+        response = client.get(path, base_url=f"https://{host}", buffered=False)
+        chunks = iter(response.response)
+        first = next(chunks, b'')
+        ttfb.append(time.perf_counter() - started)
+        size = len(first)
+        for chunk in chunks:
+            size += len(chunk)
+        response.close()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        if response.status_code != 200:
+            raise SystemExit(f"{host}{path} returned {response.status_code}")
+    return ttfb, peaks, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--domain', required=True)
+    parser.add_argument('--page', required=True, help='page name under domains/<domain>/ (without .html)')
+    parser.add_argument('--cities', type=int, default=50)
+    args = parser.parse_args()
+
+    required_data = app_module.load_json(f"domains/{args.domain}/required.json")
+    service_slug = app_module.service_slug(app_module.primary_service(required_data))
+    hosts = [
+        f"{service_slug}-{app_module.city_slug(city)}-{abbr}.{args.domain}"
+        for abbr, names in sorted(app_module.db_cache.cities.items()) for city in names
+    ][:args.cities]
+    path = f"/{args.page}"
+
+    # Every request is a cold render from one client, admission control would reject most of them
+    app_module.app.config['ADMISSION_ENABLED'] = False
+    client = app_module.app.test_client()
+    get_page_fragments = app_module.get_page_fragments
+    stream_min_bytes = app_module.app.config['STREAM_MIN_BYTES']
+
+    results = {}
+    app_module.get_page_fragments = lambda *args, **kwargs: None
+    results['full'] = measure(client, hosts, path)
+    app_module.get_page_fragments = get_page_fragments
+
+    app_module.app.config['STREAM_MIN_BYTES'] = float('inf')
+    results['buffered'] = measure(client, hosts, path)
+
+    app_module.app.config['STREAM_MIN_BYTES'] = 0
+    results['streamed'] = measure(client, hosts, path)
+    app_module.app.config['STREAM_MIN_BYTES'] = stream_min_bytes
+
+    print(f"{path} on {args.domain}: {len(hosts)} cities, ~{results['full'][2]} bytes per page")
+    for mode, (ttfb, peaks, _) in results.items():
+        print(f"{mode:9}  TTFB median={statistics.median(ttfb) * 1000:8.2f}ms  p90={sorted(ttfb)[int(len(ttfb) * 0.9)] * 1000:8.2f}ms"
+              f"  peak alloc median={statistics.median(peaks) / 1024:9.1f}KiB  max={max(peaks) / 1024:9.1f}KiB")
+
+
+if __name__ == '__main__':
+    main()
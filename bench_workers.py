@@ -0,0 +1,259 @@
+"""Benchmark how app.py scales across worker processes.
+
+Starts N independent worker processes serving app.py (each one loads its own
+DatabaseCache, SimpleCache and spintax seed cache, exactly like production
+workers), drives them with a local load generator across state, city and
+page routes, and reports throughput (2xx responses only, anything else counts
+as an error) and resident memory for every N.
+
+Usage:
+    python bench_workers.py --domain demo.com --workers 1,2,4,8 --duration 10
+    python bench_workers.py --domain demo.com --plot scaling.png --csv scaling.csv
+
+Run it from the directory that holds newcities.db and domains/.
+"""
+import argparse
+import csv
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+RESERVED_PAGES = {'home', 'city', 'state', '404'}
+
+
+def serve(port):
+    """Entry point for a single worker process"""
+    import logging
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+    app_module.app.run(host='127.0.0.1', port=port, threaded=True, use_reloader=False)
+
+
+def build_targets(domain, max_cities):
+    """Build the (host, path) mix from the domain folder and the city database"""
+    with open(f"domains/{domain}/required.json", 'r') as f:
+        required_data = json.load(f)
+    services = required_data.get('main-service', '')
+    # 'main-service' may list several services, the first one is benchmarked
+    service = services[0] if isinstance(services, list) and services else services
+    service_slug = (service or '').lower().replace(' ', '-')
+    if not service_slug:
+        raise SystemExit(f"No 'main-service' defined in domains/{domain}/required.json")
+
+    pages = sorted(
+        name[:-5] for name in os.listdir(f"domains/{domain}")
+        if name.endswith('.html') and name[:-5] not in RESERVED_PAGES
+    )
+
+    with sqlite3.connect('newcities.db') as conn:
+        rows = conn.execute(
+            "SELECT city_name, state_code FROM Cities ORDER BY id LIMIT ?", (max_cities,)
+        ).fetchall()
+
+    targets = []
+    for state in sorted({state_code.lower() for _, state_code in rows}):
+        targets.append((f"{state}.{domain}", '/'))
+    for city_name, state_code in rows:
+        city_slug = city_name.lower().replace(' ', '-')
+        host = f"{service_slug}-{city_slug}-{state_code.lower()}.{domain}"
+        targets.append((host, '/'))
+        for page in pages:
+            targets.append((host, f"/{page}"))
+    return targets
+
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def read_rss_kb(pid):
+    """Return (VmRSS, VmHWM) in KiB for a process, or (0, 0) if unavailable"""
+    rss = hwm = 0
+    try:
+        with open(f"/proc/{pid}/status", 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+                elif line.startswith('VmHWM:'):
+                    hwm = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, hwm
+
+
+def client_loop(args):
+    """Load generator process: hit targets round-robin across worker ports until the deadline"""
+    client_id, ports, targets, deadline = args
+    latencies = []
+    errors = 0
+    i = client_id
+    while time.time() < deadline:
+        host, path = targets[i % len(targets)]
+        port = ports[i % len(ports)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            conn.request('GET', path, headers={'Host': host})
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            if not 200 <= response.status < 300:
+                # 404s, 429/503 from admission control and 5xx are not rendered pages
+                errors += 1
+                continue
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+    return latencies, errors
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_round(n_workers, args, targets):
+    ports = [args.base_port + i for i in range(n_workers)]
+    workers = [
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--serve', str(port)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            # All load comes from 127.0.0.1, admission control would reject most of it
+            env=dict(os.environ, ADMISSION_ENABLED='0'),
+        )
+        for port in ports
+    ]
+    try:
+        for port in ports:
+            if not wait_for_port(port):
+                raise SystemExit(f"Worker on port {port} did not start")
+
+        # Warm every worker over the whole target set so steady-state caches are populated
+        warm_deadline = time.time() + args.warmup
+        with multiprocessing.Pool(args.clients) as pool:
+            pool.map(client_loop, [(c, ports, targets, warm_deadline) for c in range(args.clients)])
+
+        started = time.time()
+        deadline = started + args.duration
+        with multiprocessing.Pool(args.clients) as pool:
+            results = pool.map(client_loop, [(c, ports, targets, deadline) for c in range(args.clients)])
+        elapsed = time.time() - started
+
+        latencies = sorted(l for lat, _ in results for l in lat)
+        errors = sum(err for _, err in results)
+        rss = [read_rss_kb(w.pid) for w in workers]
+    finally:
+        for w in workers:
+            w.terminate()
+        for w in workers:
+            w.wait()
+
+    total_rss_mb = sum(r for r, _ in rss) / 1024.0
+    return {
+        'workers': n_workers,
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'rss_total_mb': total_rss_mb,
+        'rss_per_worker_mb': total_rss_mb / n_workers,
+        'rss_peak_per_worker_mb': max(h for _, h in rss) / 1024.0,
+    }
+
+
+def plot(rows, path):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib is not installed, skipping plot")
+        return
+
+    workers = [r['workers'] for r in rows]
+    fig, ax1 = plt.subplots(figsize=(8, 5))
+    ax1.plot(workers, [r['throughput_rps'] for r in rows], 'o-', color='tab:blue', label='throughput')
+    ax1.plot(workers, [rows[0]['throughput_rps'] * w / rows[0]['workers'] for w in workers],
+             ':', color='tab:blue', label='linear scaling')
+    ax1.set_xlabel('worker processes')
+    ax1.set_ylabel('requests / s', color='tab:blue')
+    ax2 = ax1.twinx()
+    ax2.plot(workers, [r['rss_total_mb'] for r in rows], 's-', color='tab:red', label='total RSS')
+    ax2.set_ylabel('total RSS (MB)', color='tab:red')
+    fig.legend(loc='upper left')
+    fig.tight_layout()
+    fig.savefig(path)
+    print(f"Plot written to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--domain', help='domain folder under domains/ to benchmark')
+    parser.add_argument('--workers', default='1,2,4', help='comma separated worker counts')
+    parser.add_argument('--clients', type=int, default=max(2, os.cpu_count() or 2),
+                        help='load generator processes')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds measured per round')
+    parser.add_argument('--warmup', type=float, default=3.0, help='seconds of warmup per round')
+    parser.add_argument('--max-cities', type=int, default=200, help='cities included in the route mix')
+    parser.add_argument('--base-port', type=int, default=8100)
+    parser.add_argument('--csv', help='write results to this CSV file')
+    parser.add_argument('--plot', help='write a throughput/RSS plot to this PNG file')
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+    if not args.domain:
+        parser.error('--domain is required')
+
+    targets = build_targets(args.domain, args.max_cities)
+    print(f"Route mix: {len(targets)} targets for {args.domain}")
+
+    rows = []
+    for n in [int(w) for w in args.workers.split(',') if w.strip()]:
+        row = run_round(n, args, targets)
+        rows.append(row)
+        print(f"workers={row['workers']:>3}  req/s={row['throughput_rps']:9.1f}  "
+              f"p50={row['p50_ms']:7.2f}ms  p99={row['p99_ms']:7.2f}ms  errors={row['errors']:<5} "
+              f"rss total={row['rss_total_mb']:8.1f}MB  per worker={row['rss_per_worker_mb']:6.1f}MB")
+
+    if rows:
+        base = rows[0]
+        print("\nScaling efficiency (throughput / (linear extrapolation of first round)):")
+        for row in rows:
+            ideal = base['throughput_rps'] * row['workers'] / base['workers']
+            print(f"  workers={row['workers']:>3}  efficiency={row['throughput_rps'] / ideal * 100 if ideal else 0:6.1f}%")
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"Results written to {args.csv}")
+    if args.plot:
+        plot(rows, args.plot)
+
+
+if __name__ == '__main__':
+    main()
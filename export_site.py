@@ -0,0 +1,234 @@
+"""Export a domain as static pages and sync exports by manifest.
+
+Every page the app serves for a domain (main domain home, one home per state,
+one home per city and service, and every page of each of those) is rendered in-process
+through the Flask test client, enumerated from the same DatabaseCache states and
+cities the app uses. Each export writes a manifest.json of
+(path, sha256, size) next to the pages; files whose content did not change are
+left untouched, so an export after a required.json or city.html edit only
+rewrites the affected pages.
+
+Commands:
+    python export_site.py export demo.com out/            render and write manifest
+    python export_site.py manifest out/                   (re)build a directory's manifest
+    python export_site.py diff old/ new/                  added, changed and removed files
+    python export_site.py sync new/ /srv/demo.com/        copy only what diff reports
+
+diff and sync accept either manifest files or exported directories. Run it from
+the directory that holds newcities.db and domains/.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+MANIFEST_NAME = 'manifest.json'
+RESERVED_PAGES = {'home', 'city', 'state', '404'}
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_manifest(directory):
+    """Hash every file under directory except the manifest itself"""
+    files = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            full_path = os.path.join(root, name)
+            relative = os.path.relpath(full_path, directory).replace(os.sep, '/')
+            if relative == MANIFEST_NAME:
+                continue
+            files[relative] = {'sha256': file_digest(full_path), 'size': os.path.getsize(full_path)}
+    return {'files': dict(sorted(files.items()))}
+
+
+def write_manifest(directory, manifest):
+    with open(os.path.join(directory, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def load_manifest(location):
+    """Read a manifest file, or the manifest of an exported directory (built if missing)"""
+    if os.path.isdir(location):
+        path = os.path.join(location, MANIFEST_NAME)
+        if not os.path.exists(path):
+            return build_manifest(location)
+        location = path
+    with open(location, 'r') as f:
+        return json.load(f)
+
+
+def diff_manifests(old, new):
+    """Return sorted (added, changed, removed) paths between two manifests"""
+    old_files = old['files']
+    new_files = new['files']
+    added = sorted(path for path in new_files if path not in old_files)
+    removed = sorted(path for path in old_files if path not in new_files)
+    changed = sorted(
+        path for path, entry in new_files.items()
+        if path in old_files and old_files[path]['sha256'] != entry['sha256']
+    )
+    return added, changed, removed
+
+
+def page_names(directory):
+    if not os.path.isdir(directory):
+        return set()
+    return {
+        name[:-5] for name in os.listdir(directory)
+        if name.endswith('.html') and name[:-5] not in RESERVED_PAGES
+    }
+
+
+def enumerate_pages(app_module, domain):
+    """Yield (host, path, output file) for every page served for domain"""
+    required_data = app_module.load_json(f"domains/{domain}/required.json")
+    services = app_module.domain_services(required_data)
+    if not services:
+        raise SystemExit(f"No 'main-service' defined in domains/{domain}/required.json")
+    domain_pages = page_names(f"domains/{domain}")
+
+    yield domain, '/', f"{domain}/index.html"
+    db_cache = app_module.db_cache
+    for abbr in sorted(db_cache.states):
+        host = f"{abbr}.{domain}"
+        yield host, '/', f"{host}/index.html"
+    for service in services:
+        service_slug = app_module.service_slug(service)
+        # A service serves the domain's pages plus its own (domains/<domain>/services/<slug>/)
+        pages = sorted(domain_pages | page_names(f"domains/{domain}/services/{service_slug}"))
+        for abbr in sorted(db_cache.cities):
+            for city in db_cache.cities[abbr]:
+                host = f"{service_slug}-{app_module.city_slug(city)}-{abbr}.{domain}"
+                yield host, '/', f"{host}/index.html"
+                for page in pages:
+                    yield host, f"/{page}", f"{host}/{page}.html"
+
+
+def export(domain, out_dir, limit=None):
+    import app as app_module
+    app_module.app.config['ADMISSION_ENABLED'] = False
+    client = app_module.app.test_client()
+
+    old_manifest = load_manifest(out_dir) if os.path.isdir(out_dir) else {'files': {}}
+    pages = list(enumerate_pages(app_module, domain))
+    files = {}
+    exported = written = skipped = 0
+    for host, path, output in pages[:limit]:
+        response = client.get(path, base_url=f"https://{host}")
+        if response.status_code != 200:
+            print(f"Skipping {host}{path}: {response.status_code}", file=sys.stderr)
+            skipped += 1
+            continue
+        body = response.get_data()
+        digest = hashlib.sha256(body).hexdigest()
+        files[output] = {'sha256': digest, 'size': len(body)}
+        exported += 1
+        full_path = os.path.join(out_dir, output)
+        previous = old_manifest['files'].get(output)
+        if previous and previous['sha256'] == digest and os.path.exists(full_path):
+            continue
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as f:
+            f.write(body)
+        written += 1
+
+    # Only pages the site no longer has are removed. Pages that failed to render
+    # this time, or were not rendered because of --limit, keep their previous export.
+    produced = {output for _, _, output in pages}
+    removed = []
+    for path, entry in old_manifest['files'].items():
+        if path in files:
+            continue
+        if path in produced or limit is not None:
+            files[path] = entry
+        else:
+            removed.append(path)
+    for path in removed:
+        full_path = os.path.join(out_dir, path)
+        if os.path.exists(full_path):
+            os.remove(full_path)
+
+    manifest = {'files': dict(sorted(files.items()))}
+    os.makedirs(out_dir, exist_ok=True)
+    write_manifest(out_dir, manifest)
+    print(f"{exported} pages exported to {out_dir}: {written} written, {exported - written} unchanged, "
+          f"{len(removed)} removed, {skipped} skipped")
+    if limit is not None:
+        print(f"Only the first {limit} of {len(pages)} pages were rendered, nothing was removed")
+
+
+def sync(source, target, dry_run=False):
+    """Copy added and changed files from source to target and delete removed ones"""
+    new = load_manifest(source)
+    old = load_manifest(target) if os.path.isdir(target) else {'files': {}}
+    added, changed, removed = diff_manifests(old, new)
+    copied = 0
+    for path in added + changed:
+        copied += new['files'][path]['size']
+        if dry_run:
+            continue
+        destination = os.path.join(target, path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copyfile(os.path.join(source, path), destination)
+    if not dry_run:
+        for path in removed:
+            full_path = os.path.join(target, path)
+            if os.path.exists(full_path):
+                os.remove(full_path)
+        os.makedirs(target, exist_ok=True)
+        write_manifest(target, new)
+    print(f"{len(added)} added, {len(changed)} changed, {len(removed)} removed, "
+          f"{copied} bytes {'to copy' if dry_run else 'copied'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help='render every page of a domain to a directory')
+    export_parser.add_argument('domain')
+    export_parser.add_argument('out_dir')
+    export_parser.add_argument('--limit', type=int, help='only render the first N pages (removes nothing)')
+
+    manifest_parser = commands.add_parser('manifest', help='write the manifest of a directory')
+    manifest_parser.add_argument('directory')
+
+    diff_parser = commands.add_parser('diff', help='list added (A), changed (M) and removed (D) files')
+    diff_parser.add_argument('old')
+    diff_parser.add_argument('new')
+    diff_parser.add_argument('--json', action='store_true', help='print the diff as JSON')
+
+    sync_parser = commands.add_parser('sync', help='copy only the files that differ')
+    sync_parser.add_argument('source')
+    sync_parser.add_argument('target')
+    sync_parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export(args.domain, args.out_dir, args.limit)
+    elif args.command == 'manifest':
+        manifest = build_manifest(args.directory)
+        write_manifest(args.directory, manifest)
+        print(f"{len(manifest['files'])} files in {os.path.join(args.directory, MANIFEST_NAME)}")
+    elif args.command == 'diff':
+        added, changed, removed = diff_manifests(load_manifest(args.old), load_manifest(args.new))
+        if args.json:
+            print(json.dumps({'added': added, 'changed': changed, 'removed': removed}, indent=1))
+        else:
+            for status, paths in (('A', added), ('M', changed), ('D', removed)):
+                for path in paths:
+                    print(f"{status} {path}")
+    elif args.command == 'sync':
+        sync(args.source, args.target, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
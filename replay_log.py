@@ -0,0 +1,288 @@
+"""Replay nginx access logs against app.py and report latency and cache hit rate per route.
+
+Reads nginx "combined" access logs (plain or .gz). The combined format has no
+Host, so the host is taken from, in order:
+
+    a trailing quoted field   log_format replay '$remote_addr - ... "$http_user_agent" "$host"';
+    a leading field           --format vhost, for '$host $remote_addr - ...' logs
+    --default-host            for logs of a single domain
+
+Only GET and HEAD requests are replayed. By default they run in-process
+through the Flask test client (no network, no server), with --url against a
+running server instead. --speed scales the recorded timing (1 replays in real
+time, 60 a recorded hour in a minute, 0 as fast as --concurrency allows).
+
+Requests are grouped into routes by the shape of host and path (main, state
+and city homes, city pages, /api, /static, /domains), and each route reports
+its latency percentiles, status codes, how many statuses differ from the log,
+and the X-Cache hit rate (HIT / HIT+MISS+COALESCED).
+
+Usage:
+    python replay_log.py access.log.gz --concurrency 8
+    python replay_log.py access.log --default-host demo.com --speed 10 --limit 50000
+    python replay_log.py access.log --url http://127.0.0.1:5000 --json report.json
+
+Run it from the directory that holds newcities.db and domains/.
+"""
+import argparse
+import gzip
+import http.client
+import json
+import queue
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from urllib.parse import urlsplit
+
+LOG_PATTERN = re.compile(
+    r'(?:(?P<vhost>\S+) )?'
+    r'(?P<remote>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] '
+    r'"(?P<method>[A-Z]+) (?P<path>\S+)(?: [^"]*)?" (?P<status>\d{3}) \S+'
+    r'(?: "(?:[^"\\]|\\.)*" "(?:[^"\\]|\\.)*")?'
+    r'(?: "(?P<host>[^"]*)")?'
+)
+TIME_FORMAT = '%d/%b/%Y:%H:%M:%S %z'
+REPLAYED_METHODS = {'GET', 'HEAD'}
+CACHE_STATES = ('HIT', 'MISS', 'COALESCED')
+
+
+def open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, 'r', encoding='utf-8', errors='replace')
+
+
+def parse_log(paths, log_format='combined', default_host=None):
+    """Yield (timestamp, method, host, path, recorded status) and count skipped lines in parse_log.skipped"""
+    skipped = parse_log.skipped = Counter()
+    for log_path in paths:
+        with open_log(log_path) as f:
+            for line in f:
+                match = LOG_PATTERN.match(line)
+                if not match:
+                    skipped['unparsed'] += 1
+                    continue
+                if match['method'] not in REPLAYED_METHODS:
+                    skipped['method'] += 1
+                    continue
+                host = match['vhost'] if log_format == 'vhost' else match['host']
+                host = (host or default_host or '').split(':')[0].lower()
+                if not host or host == '-':
+                    skipped['no host'] += 1
+                    continue
+                try:
+                    timestamp = datetime.strptime(match['time'], TIME_FORMAT).timestamp()
+                except ValueError:
+                    skipped['unparsed'] += 1
+                    continue
+                yield timestamp, match['method'], host, match['path'], int(match['status'])
+
+
+def route_of(host, path):
+    """Group a request by the shape of its host and path, e.g. 'city /<page>'"""
+    path = path.split('?')[0]
+    for prefix in ('/api/', '/static/', '/domains/', '/admin/'):
+        if path.startswith(prefix):
+            return f"{prefix}*"
+    labels = host.split('.')
+    if len(labels) <= 2:
+        kind = 'main'
+    elif len(labels[0]) == 2 and labels[0].isalpha():
+        kind = 'state'
+    else:
+        kind = 'city'
+    if path == '/':
+        return f"{kind} /"
+    if path.count('/') == 1:
+        return f"{kind} /<page>"
+    return f"{kind} other"
+
+
+class RouteStats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.cache = Counter()
+        self.status_changed = 0
+        self.errors = 0
+
+
+class Replayer:
+    """Worker threads that send queued requests and record the results per route"""
+
+    def __init__(self, concurrency, url=None):
+        self.url = urlsplit(url) if url else None
+        self.requests = queue.Queue(maxsize=concurrency * 4)
+        self.routes = defaultdict(RouteStats)
+        self.lock = threading.Lock()
+        self.first_error = None
+        self.threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(concurrency)]
+        if not self.url:
+            import app as app_module
+            self.app = app_module.app
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        for _ in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def worker(self):
+        send = self.send_in_process if not self.url else self.send_http
+        client = self.app.test_client() if not self.url else None
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            method, host, path, recorded_status = request
+            started = time.perf_counter()
+            try:
+                client, status, cache_state = send(client, method, host, path)
+            except (OSError, http.client.HTTPException) as e:
+                client = None
+                with self.lock:
+                    self.routes[route_of(host, path)].errors += 1
+                    self.first_error = self.first_error or f"{host}{path}: {e}"
+                continue
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                stats = self.routes[route_of(host, path)]
+                stats.latencies.append(elapsed)
+                stats.statuses[status] += 1
+                if cache_state:
+                    stats.cache[cache_state] += 1
+                if status != recorded_status:
+                    stats.status_changed += 1
+
+    def send_in_process(self, client, method, host, path):
+        response = client.open(path, method=method, base_url=f"https://{host}")
+        response.get_data()
+        response.close()
+        return client, response.status_code, response.headers.get('X-Cache')
+
+    def send_http(self, conn, method, host, path):
+        if conn is None:
+            conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=30)
+        conn.request(method, path, headers={'Host': host})
+        response = conn.getresponse()
+        response.read()
+        if response.getheader('Connection', '').lower() == 'close':
+            conn.close()
+            conn = None
+        return conn, response.status, response.getheader('X-Cache')
+
+
+def replay(entries, replayer, speed=0.0, limit=None):
+    """Queue entries at their recorded offsets divided by speed; return (replayed, wall seconds, max lag)"""
+    replayer.start()
+    started = time.perf_counter()
+    first = None
+    replayed = 0
+    max_lag = 0.0
+    for timestamp, method, host, path, status in entries:
+        if limit is not None and replayed >= limit:
+            break
+        if speed > 0:
+            if first is None:
+                first = timestamp
+            due = started + max(0.0, timestamp - first) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+        replayer.requests.put((method, host, path, status))
+        replayed += 1
+    replayer.stop()
+    return replayed, time.perf_counter() - started, max_lag
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def build_report(routes):
+    report = {}
+    for route, stats in sorted(routes.items()):
+        latencies = sorted(stats.latencies)
+        lookups = sum(stats.cache[state] for state in CACHE_STATES)
+        report[route] = {
+            'requests': len(latencies) + stats.errors,
+            'errors': stats.errors,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p90_ms': round(percentile(latencies, 90) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'max_ms': round((latencies[-1] if latencies else 0.0) * 1000, 2),
+            'statuses': {str(status): count for status, count in sorted(stats.statuses.items())},
+            'status_changed': stats.status_changed,
+            'cache': dict(stats.cache),
+            'hit_rate': round(stats.cache['HIT'] / lookups, 4) if lookups else None,
+        }
+    return report
+
+
+def print_report(report):
+    print(f"{'route':16} {'requests':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} "
+          f"{'hit rate':>8} {'coalesced':>9} {'changed':>7}  statuses")
+    for route, row in report.items():
+        hit_rate = f"{row['hit_rate'] * 100:7.1f}%" if row['hit_rate'] is not None else '       -'
+        statuses = ' '.join(f"{status}:{count}" for status, count in row['statuses'].items())
+        if row['errors']:
+            statuses += f" errors:{row['errors']}"
+        print(f"{route:16} {row['requests']:>9} {row['p50_ms']:>8.2f} {row['p90_ms']:>8.2f} "
+              f"{row['p99_ms']:>8.2f} {row['max_ms']:>8.2f} {hit_rate} {row['cache'].get('COALESCED', 0):>9} "
+              f"{row['status_changed']:>7}  {statuses}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('logs', nargs='+', help='nginx access logs, .gz is decompressed')
+    parser.add_argument('--format', choices=('combined', 'vhost'), default='combined',
+                        help="'vhost' when $host is the first field of every line")
+    parser.add_argument('--default-host', help='host for lines that do not record one')
+    parser.add_argument('--url', help='replay against a running server (e.g. http://127.0.0.1:5000) instead of in-process')
+    parser.add_argument('--speed', type=float, default=0.0, help='time scale of the recorded timing, 0 for no delays')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--limit', type=int, help='only replay the first N requests')
+    parser.add_argument('--admission', action='store_true',
+                        help='keep admission control enabled for in-process replays')
+    parser.add_argument('--json', metavar='PATH', help='also write the report as JSON')
+    args = parser.parse_args()
+
+    replayer = Replayer(args.concurrency, args.url)
+    if not args.url and not args.admission:
+        # Replaying faster than recorded would be shed by admission control, measure serving only
+        replayer.app.config['ADMISSION_ENABLED'] = False
+
+    entries = parse_log(args.logs, args.format, args.default_host)
+    replayed, wall, max_lag = replay(entries, replayer, args.speed, args.limit)
+    skipped = ', '.join(f"{reason}: {count}" for reason, count in sorted(parse_log.skipped.items())) or 'none'
+    target = args.url or 'in-process'
+    print(f"{replayed} requests replayed {target} in {wall:.1f}s ({replayed / wall if wall else 0:.0f} req/s), "
+          f"concurrency {args.concurrency}, speed {args.speed or 'unthrottled'}; skipped lines: {skipped}",
+          file=sys.stderr)
+    if args.speed > 0 and max_lag > 1.0:
+        print(f"Fell up to {max_lag:.1f}s behind the recorded timing, raise --concurrency", file=sys.stderr)
+
+    if replayer.first_error:
+        print(f"First request error: {replayer.first_error}", file=sys.stderr)
+
+    report = build_report(replayer.routes)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'requests': replayed, 'wall_seconds': round(wall, 3), 'routes': report}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
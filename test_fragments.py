@@ -0,0 +1,44 @@
+"""Parity of fragment rendering with the full replace_placeholders pipeline.
+
+    python -m pytest -q test_fragments.py
+"""
+import pytest
+
+import app as app_module
+
+REQUIRED = {'Business Name': 'Acme', 'Phone': '555-0100', 'Business Email': 'hi@acme.test',
+            'Business Address': '1 Main St'}
+CITIES = [('Abilene', 'TX', 'Texas'), ('Springfield', 'IL', 'Illinois'), ('Adjuntas', 'PR', 'Puerto Rico')]
+
+PAGES = [
+    '<html><head><title>[Service] in [City]</title></head><body>'
+    '<h1>{Best|Top} [Service] in [City], [State]</h1><p>{Call|Phone} [Phone] {today|now}.</p>'
+    '<script>var x = {a: 1};</script></body></html>',
+    '<p>{[City] plumbers|Plumbers in [City-State]|[Company Name]} serve [Zip Codes].</p>',
+    '<p>Stray [ and ] brackets, [not a placeholder] and {a|b}[City]{c|d}</p>',
+    # placeholders assembled by spintax are resolved by the full pipeline
+    '<p>[{City|City}] and [{State|STATE}]</p>',
+    '<p>[Ci{ty|ty}] in {[State|[STATE}]</p>',
+    '<p>{[|[}City] {x|y}</p>',
+]
+# Pages the fragment path has to leave to the full pipeline
+FALLBACK_PAGES = (3, 4, 5)
+
+
+@pytest.mark.parametrize('page', range(len(PAGES)))
+@pytest.mark.parametrize('city, state, state_full', CITIES)
+def test_fragments_match_full_pipeline(page, city, state, state_full):
+    source = PAGES[page]
+    host = f"plumbing-{city.lower()}-{state.lower()}.example.com"
+    with app_module.app.test_request_context('/', base_url=f"https://{host}"):
+        expected = app_module.replace_placeholders(source, 'Plumbing', city, state, state_full, REQUIRED,
+                                                   ['79601', '79602'], '79601')
+        fragments = app_module.get_page_fragments(f"domains/example.com/page{page}.html", source,
+                                                  'Plumbing', REQUIRED)
+        if page in FALLBACK_PAGES:
+            assert fragments is None
+            return
+        values = app_module.placeholder_values('Plumbing', city, state, state_full, REQUIRED,
+                                               ['79601', '79602'], '79601')
+        rendered = app_module.render_page_fragments(fragments, values, f"{city}|{state}")
+    assert rendered.decode('utf-8') == expected
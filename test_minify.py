@@ -0,0 +1,38 @@
+"""Tests of page minification (MINIFY_HTML).
+
+    python -m pytest -q test_minify.py
+"""
+import pytest
+
+import app as app_module
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('<p>a  <!-- note -->\n\n  b</p>', '<p>a\nb</p>'),
+    ('<pre> a  b </pre>  <textarea>x\n\n y</textarea>', '<pre> a  b </pre> <textarea>x\n\n y</textarea>'),
+    ('{Call us|Visit<!-- } --> today}', '{Call us|Visit<!-- } --> today}'),
+    ('{a<!-- | -->|b}  c', '{a<!-- | -->|b} c'),
+    ('{{ "a   b" }}   {% set x = "c    d" %}  e', '{{ "a   b" }} {% set x = "c    d" %} e'),
+    ('<!--[if IE]>  <p>old</p>  <![endif]-->', '<!--[if IE]>  <p>old</p>  <![endif]-->'),
+])
+def test_minify_html(text, expected):
+    assert app_module.minify_html(text) == expected
+
+
+@pytest.mark.parametrize('text', [
+    '<p>{Call|Phone} us   today</p>\n\n<!-- remove me --><p>[City]</p>',
+    '{Call us|Visit<!-- } --> today}',
+    '{{ "a   b" }}  {%20 off|sale}  {#1 rated|top}',
+])
+def test_minified_pages_are_equivalent(text):
+    assert app_module.minified_equivalent(text, app_module.minify_html(text))
+
+
+@pytest.mark.parametrize('original, minified', [
+    # dropping a comment that closes a spintax group changes the choices
+    ('{Call us|Visit<!-- } --> today}', '{Call us|Visit today}'),
+    ('a {b|c} d', 'a {b|c}d'),
+    ('<p>[City]  is   great</p>', '<p>[City]is great</p>'),
+])
+def test_changed_pages_are_not_equivalent(original, minified):
+    assert not app_module.minified_equivalent(original, minified)
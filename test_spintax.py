@@ -0,0 +1,107 @@
+"""Regression tests for spintax resolution.
+
+Pages without nested groups, escapes or Jinja must resolve exactly as the
+previous single regex did; nested groups and Jinja-adjacent braces are pinned
+against choices drawn independently from the same city seed.
+
+Run from the directory that holds newcities.db:
+    python -m pytest -q test_spintax.py
+"""
+import hashlib
+import random
+import re
+
+import pytest
+
+import app as app_module
+
+CITY_KEYS = ['Abilene|TX', 'Springfield|IL', 'Adjuntas|PR', 'Nowhere|ZZ']
+
+# Representative page bodies: headings, paragraphs, attributes, placeholders,
+# empty options, adjacent groups and stray '}' or '|' outside any group
+PAGES = [
+    '<h1>{Best|Top|Trusted} [Service] in [City], [State]</h1>\n'
+    '<p>{Call|Phone|Contact} us {today|now|}! {We|Our team} {serve|cover} [City] and {nearby|surrounding} areas.</p>\n',
+    ''.join(f'<h2>{{Step|Stage}} {i}</h2><p>{{Fast|Quick|Rapid}} {{and|&amp;}} {{reliable|dependable}} work.</p>\n'
+            for i in range(50)),
+    '<a href="/contact" title="{Get a quote|Free estimate}">{Click here|Contact us}</a>{|!}{|!}',
+    'Prices } start at $99 | no hidden fees {always|guaranteed}. Open 24/7 | {Mon-Sun|every day}',
+    '<ul>' + ''.join(f'<li>{{Drain|Pipe|Sewer}} {{cleaning|repair}} #{i}</li>' for i in range(200)) + '</ul>',
+    'no spintax at all, just [City] text',
+    '',
+]
+
+
+def legacy_resolve(text, city_state_key):
+    """Spintax resolution of the previous implementation"""
+    seed = int(hashlib.md5(city_state_key.encode()).hexdigest(), 16) % (2**32)
+    rng = random.Random(seed)
+    return re.sub(r'\{([^}]*)\}', lambda match: rng.choice(match.group(1).split('|')), text)
+
+
+def choices(city_state_key, *option_counts):
+    """The option index drawn for each group, in document pre-order"""
+    seed = int(hashlib.md5(city_state_key.encode()).hexdigest(), 16) % (2**32)
+    rng = random.Random(seed)
+    return [rng.choice(range(count)) for count in option_counts]
+
+
+@pytest.fixture(autouse=True)
+def clear_spintax_caches():
+    app_module.spintax_templates.clear()
+    app_module.spintax_choices.clear()
+
+
+@pytest.mark.parametrize('page', range(len(PAGES)))
+@pytest.mark.parametrize('key', CITY_KEYS)
+def test_flat_pages_resolve_as_before(page, key):
+    assert app_module.resolve_spintax(PAGES[page], key) == legacy_resolve(PAGES[page], key)
+
+
+@pytest.mark.parametrize('page', range(len(PAGES)))
+def test_flat_parser_matches_nested_parser(page):
+    flat = app_module._parse_flat_spintax(PAGES[page])
+    assert flat is not None
+    items, option_counts = app_module._parse_nested_spintax(PAGES[page])
+    assert (list(flat[0]), flat[1]) == (items, option_counts)
+
+
+@pytest.mark.parametrize('key', CITY_KEYS)
+def test_nested_groups(key):
+    outer, inner = choices(key, 2, 3)
+    expected = 'b' if outer == 0 else ['c', 'd', 'e'][inner]
+    assert app_module.resolve_spintax('A {b|{c|d|e}} F', key) == f"A {expected} F"
+
+
+@pytest.mark.parametrize('key', CITY_KEYS)
+def test_group_starting_with_group(key):
+    outer, inner = choices(key, 2, 2)
+    expected = ['a', 'b'][inner] if outer == 0 else 'c'
+    assert app_module.resolve_spintax('{{a|b}|c} {{ name }}', key) == f"{expected} {{{{ name }}}}"
+
+
+@pytest.mark.parametrize('key', CITY_KEYS)
+def test_jinja_constructs_pass_through(key):
+    first, second = choices(key, 2, 3)
+    text = '{% if x %}{a|b}{% endif %} {{ x|upper }} {# note #} {c|d|e}'
+    expected = f"{{% if x %}}{['a', 'b'][first]}{{% endif %}} {{{{ x|upper }}}} {{# note #}} {['c', 'd', 'e'][second]}"
+    assert app_module.resolve_spintax(text, key) == expected
+
+
+@pytest.mark.parametrize('key', CITY_KEYS)
+def test_groups_starting_with_jinja_characters(key):
+    first, second = choices(key, 2, 2)
+    text = '{%20 off|big sale} and {#1 rated|top rated} {% if x %}y{% endif %} {# c #}'
+    expected = (f"{['%20 off', 'big sale'][first]} and {['#1 rated', 'top rated'][second]} "
+                f"{{% if x %}}y{{% endif %}} {{# c #}}")
+    assert app_module.resolve_spintax(text, key) == expected
+
+
+@pytest.mark.parametrize('key', CITY_KEYS)
+def test_escapes_are_literal(key):
+    (index,) = choices(key, 2)
+    assert app_module.resolve_spintax(r'\{not\|spun\} {a|b}', key) == f"{{not|spun}} {['a', 'b'][index]}"
+
+
+def test_unclosed_braces_are_literal():
+    assert app_module.resolve_spintax('{{ x {% y {# z {', 'Abilene|TX') == '{{ x {% y {# z {'
@@ -0,0 +1,69 @@
+"""Tests of page uploads through /update-files.
+
+Each test runs in an empty directory, so uploads never touch the real domains/:
+    python -m pytest -q test_update_files.py
+"""
+import json
+
+import pytest
+
+import app as app_module
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Pages cached by an earlier test were rendered from another directory
+    app_module.invalidate_pages(app_module.dependency_graph.pages())
+    return app_module.app.test_client()
+
+
+def upload(client, filename, content):
+    return client.put('/update-files', json={
+        'domain': 'example.com',
+        'files': [{'filename': filename, 'content': content}],
+    })
+
+
+@pytest.mark.parametrize('content', [
+    '<p>{%20 off|sale} today in {{ city }}</p>',
+    '<p>{#1 rated|top rated} [Service] in {{ city }}</p>',
+    '<ul>{% for city, url in other_city_links.items() %}<li>{Call|Visit} [City]</li>{% endfor %}</ul>',
+])
+def test_spintax_groups_starting_with_jinja_characters_are_accepted(client, content):
+    response = upload(client, 'city.html', content)
+    assert response.status_code == 200, response.get_json()
+
+
+@pytest.mark.parametrize('filename, content', [
+    ('city.html', '<p>{Call|Visit} {{ city </p>'),
+    ('about.html', '<p>{% for x in y %}{{ x }}</p>'),
+    ('home.html', '<p>{%20 off|sale}</p>'),
+])
+def test_broken_templates_are_rejected(client, filename, content):
+    response = upload(client, filename, content)
+    assert response.status_code == 400
+    assert 'Template error' in response.get_json()['error']
+
+
+def test_json_edits_only_re_render_pages_using_the_changed_fields(client):
+    required = {'company_name': 'Acme', 'Phone': '555-0100', 'main-service': 'Plumbing'}
+    response = client.put('/update-files', json={'domain': 'example.com', 'files': [
+        {'filename': 'required.json', 'content': json.dumps(required)},
+        {'filename': 'home.html', 'content': '<h1>{{ company_name }}</h1>'},
+    ]})
+    assert response.status_code == 200
+    assert client.get('/', base_url='https://example.com').headers['X-Cache'] == 'MISS'
+    assert client.get('/', base_url='https://example.com').headers['X-Cache'] == 'HIT'
+
+    required['Phone'] = '555-0199'
+    response = upload(client, 'required.json', json.dumps(required))
+    assert response.get_json()['invalidated_pages'] == 0
+    assert client.get('/', base_url='https://example.com').headers['X-Cache'] == 'HIT'
+
+    required['company_name'] = 'Acme Plumbing'
+    response = upload(client, 'required.json', json.dumps(required))
+    assert response.get_json()['invalidated_pages'] == 1
+    response = client.get('/', base_url='https://example.com')
+    assert response.headers['X-Cache'] == 'MISS'
+    assert b'Acme Plumbing' in response.get_data()